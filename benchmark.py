@@ -0,0 +1,304 @@
+# Measures checkpoint and restore throughput, latency, peak memory and bytes
+# written for synthetic parameter dicts, against local storage so the results
+# do not depend on the network. Each workload/strategy pair runs in its own
+# process, which keeps peak RSS figures separate.
+#
+#   python benchmark.py --size 256 --repeat 5
+#   python benchmark.py --workload optimizer --strategy default zlib chunk-store
+#   python benchmark.py --storage memory:// --output results.jsonl
+#
+# --storage also takes s3://bucket, e.g. a local minio server with
+# AWS_ENDPOINT_URL set, to include an S3 client in the measurements.
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from dalmatian import dalmatian as dalm
+from dalmatian import serialization
+from dalmatian.storage import StorageBackend, open_storage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MB = 1024 * 1024
+INSTANCE_NAME = "benchmark"
+
+
+class Array(bytearray):
+    # Stands in for numpy arrays when numpy is not installed. Like them, its
+    # data is pickled out-of-band.
+    def __reduce_ex__(self, protocol):
+        return Array, (pickle.PickleBuffer(self),)
+
+
+def make_array(nbytes):
+    # Rounded down to whole float32 elements
+    data = os.urandom(nbytes - nbytes % 4)
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=numpy.float32).copy()
+    return Array(data)
+
+
+def small_params(size):
+    # Many small parameters, e.g. metrics and schedules, of about 16KB each
+    rng = random.Random(0)
+    return {
+        "param-{}".format(i): [rng.random() for _ in range(2048)]
+        for i in range(max(1, size // (16 * 1024)))
+    }
+
+
+def huge_arrays(size):
+    return {"array-{}".format(i): make_array(size // 4) for i in range(4)}
+
+
+def optimizer(size, layers=32):
+    # A model with an Adam-style optimizer state, which holds two more arrays
+    # the size of every weight
+    layer_size = size // (3 * layers)
+    return {
+        "model": {"layer-{}".format(i): make_array(layer_size) for i in range(layers)},
+        "optimizer": {
+            "state": {
+                i: {
+                    "step": 0,
+                    "exp_avg": make_array(layer_size),
+                    "exp_avg_sq": make_array(layer_size),
+                }
+                for i in range(layers)
+            },
+            "param_groups": [{"lr": 0.001, "betas": [0.9, 0.999]}],
+        },
+        "epoch": 0,
+    }
+
+
+def mixed(size):
+    return {**huge_arrays(size // 2), **small_params(size // 2), "epoch": 0}
+
+
+WORKLOADS = {
+    "small-params": small_params,
+    "huge-arrays": huge_arrays,
+    "optimizer": optimizer,
+    "mixed": mixed,
+}
+
+# Instance options for each strategy, given a scratch directory
+STRATEGIES = {
+    "default": lambda scratch: {},
+    "pickle": lambda scratch: {"codec": "pickle"},
+    "zlib": lambda scratch: {"compression": "zlib"},
+    "serial": lambda scratch: {"concurrency": 1},
+    "chunk-store": lambda scratch: {"chunk_store": True},
+    "staging": lambda scratch: {"staging_dir": os.path.join(scratch, "staging")},
+    "lazy": lambda scratch: {"lazy": True},
+}
+
+
+def mutate(obj, fraction, rng):
+    # Changes about `fraction` of every value in place, the way training
+    # would between checkpoints
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if type(value) is int:
+                obj[key] = value + 1
+            else:
+                mutate(value, fraction, rng)
+    elif isinstance(obj, list):
+        for i in rng.sample(range(len(obj)), int(len(obj) * fraction)):
+            if type(obj[i]) is float:
+                obj[i] = rng.random()
+    elif isinstance(obj, Array) or (
+        numpy is not None and isinstance(obj, numpy.ndarray)
+    ):
+        view = memoryview(obj).cast("B")
+        count = int(len(view) * fraction)
+        start = rng.randrange(len(view) - count + 1)
+        view[start : start + count] = os.urandom(count)
+
+
+class CountingBackend(StorageBackend):
+    # Passes everything through to another backend, counting bytes written
+    def __init__(self, backend):
+        self.backend = backend
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def _count(self, data):
+        with self._lock:
+            self.bytes_written += len(memoryview(data).cast("B"))
+
+    def put(self, key, data):
+        self._count(data)
+        return self.backend.put(key, data)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_range(self, key, start, end):
+        return self.backend.get_range(key, start, end)
+
+    def size(self, key):
+        return self.backend.size(key)
+
+    def list(self, prefix):
+        return self.backend.list(prefix)
+
+    def delete(self, keys):
+        return self.backend.delete(keys)
+
+    def create_multipart(self, key):
+        return self.backend.create_multipart(key)
+
+    def upload_part(self, key, upload_id, number, data):
+        self._count(data)
+        return self.backend.upload_part(key, upload_id, number, data)
+
+    def list_parts(self, key, upload_id):
+        return self.backend.list_parts(key, upload_id)
+
+    def complete_multipart(self, key, upload_id, parts):
+        return self.backend.complete_multipart(key, upload_id, parts)
+
+    def abort_multipart(self, key, upload_id):
+        return self.backend.abort_multipart(key, upload_id)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(workload, strategy, args):
+    scratch = tempfile.mkdtemp(prefix="dalmatian-benchmark-")
+    try:
+        storage = CountingBackend(
+            open_storage(args.storage or "file://" + os.path.join(scratch, "storage"))
+        )
+        options = STRATEGIES[strategy](scratch)
+        state = WORKLOADS[workload](args.size * MB)
+        size = sum(len(serialization.dumps(value)) for value in state.values())
+        rng = random.Random(1)
+
+        instance = dalm.Instance(INSTANCE_NAME, storage=storage, **options)
+        instance.update_parameters(state)
+        storage.bytes_written = 0
+        saves = []
+        for i in range(args.repeat):
+            if i:
+                mutate(state, args.change, rng)
+            start = time.perf_counter()
+            assert instance.save(), "Checkpoint failed"
+            saves.append(time.perf_counter() - start)
+        written = storage.bytes_written
+        instance.close()
+
+        restores = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            restored = dalm.Instance(INSTANCE_NAME, storage=storage, **options)
+            assert restored.storage_initialized, "Restore failed"
+            # Lazy restores are only done once every parameter has been read
+            for key in state:
+                restored.get_parameter(key)
+            restores.append(time.perf_counter() - start)
+            restored.close()
+        restored.erase()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024  # kilobytes everywhere else
+    return {
+        "workload": workload,
+        "strategy": strategy,
+        "size_mb": size / MB,
+        "save_mb_s": size / MB / percentile(saves, 0.5),
+        "save_p50": percentile(saves, 0.5),
+        "save_p99": percentile(saves, 0.99),
+        "restore_mb_s": size / MB / percentile(restores, 0.5),
+        "restore_p50": percentile(restores, 0.5),
+        "restore_p99": percentile(restores, 0.99),
+        "written_mb": written / MB,
+        "peak_rss_mb": peak_rss / MB,
+    }
+
+
+COLUMNS = [
+    ("workload", "{:<13}"),
+    ("strategy", "{:<12}"),
+    ("size_mb", "{:>9.1f}"),
+    ("save_mb_s", "{:>10.1f}"),
+    ("save_p50", "{:>9.3f}"),
+    ("save_p99", "{:>9.3f}"),
+    ("restore_mb_s", "{:>13.1f}"),
+    ("restore_p50", "{:>12.3f}"),
+    ("restore_p99", "{:>12.3f}"),
+    ("written_mb", "{:>11.1f}"),
+    ("peak_rss_mb", "{:>12.1f}"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dalmatian checkpoint benchmarks")
+    parser.add_argument(
+        "--workload", nargs="+", default=sorted(WORKLOADS), choices=sorted(WORKLOADS)
+    )
+    parser.add_argument(
+        "--strategy",
+        nargs="+",
+        default=sorted(STRATEGIES),
+        choices=sorted(STRATEGIES),
+    )
+    parser.add_argument(
+        "--size", type=int, default=64, help="size of the state in MB (default: 64)"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="saves and restores to time (default: 5)",
+    )
+    parser.add_argument(
+        "--change",
+        type=float,
+        default=1.0,
+        help="fraction of the state changed between saves (default: 1.0)",
+    )
+    parser.add_argument(
+        "--storage", help="storage URL to use instead of a temporary directory"
+    )
+    parser.add_argument("--output", help="append results to this file as JSON lines")
+    args = parser.parse_args()
+
+    # Keep the setup and save logging out of the results
+    dalm._log = lambda message: None
+    header = "".join(fmt.replace(".1f", "").replace(".3f", "") for _, fmt in COLUMNS)
+    row = "".join(fmt for _, fmt in COLUMNS)
+    print(header.format(*(name for name, _ in COLUMNS)))
+    context = multiprocessing.get_context("fork")
+    for workload in args.workload:
+        for strategy in args.strategy:
+            with context.Pool(1) as pool:
+                result = pool.apply(run, (workload, strategy, args))
+            print(row.format(*(result[name] for name, _ in COLUMNS)), flush=True)
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ from pprint import pprint
 from collections import OrderedDict
 import configparser
 from haikunator import Haikunator
-import boto3 as boto
+from dalmatian.clients import resource
 
 # Haikunator builds two word random names
 hkn = Haikunator()
@@ -18,9 +18,6 @@ DEFAULT = {
     'S3Bucket': build_name(token_length=4)
     }
 
-# AWS interface used for validating config
-ec2 = boto.resource('ec2')
-
 def build_config():
 
     print()
@@ -97,7 +94,8 @@ def validator(test):
 
 @validator
 def validate_ami(ami):
-    image = ec2.Image(ami)
+    # AWS interface used for validating config
+    image = resource('ec2').Image(ami)
     if image.name: return True
 
 @validator
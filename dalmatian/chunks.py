@@ -0,0 +1,100 @@
+import threading
+
+from . import serialization
+from .manifest import digest
+
+# With the chunk store, shards are split into chunks that are stored once for
+# the whole bucket, named by their digest, and a shard is a list of chunk
+# references:
+#
+#   chunks/{digest}
+#
+# Instances fine-tuning from the same pretrained weights share the chunks of
+# every layer they have not changed. Chunks start at the beginning of every
+# array stored out-of-band (see serialization), so identical arrays produce
+# identical chunks even when the objects around them differ, and are cut to
+# a fixed size from there. Every instance sharing chunks needs to use the same
+# chunk size.
+
+CHUNK_PREFIX = "chunks"
+# Arrays smaller than this share chunks with whatever comes before them
+MIN_CHUNK_SIZE = 64 * 1024
+
+
+def chunk_name(chunk_digest):
+    return "{}/{}".format(CHUNK_PREFIX, chunk_digest)
+
+
+def parse_chunk_name(key):
+    # The digest of the chunk stored under key, or None for other objects
+    prefix = CHUNK_PREFIX + "/"
+    if not key.startswith(prefix):
+        return None
+    return key[len(prefix) :]
+
+
+def split(data, chunk_size):
+    # Returns the (offset, length) of every chunk of data
+    boundaries = [
+        offset
+        for offset, length in serialization.buffer_layout(data)
+        if length >= MIN_CHUNK_SIZE
+    ]
+    chunks = []
+    for start, end in zip([0] + boundaries, boundaries + [len(data)]):
+        for offset in range(start, end, chunk_size):
+            chunks.append((offset, min(chunk_size, end - offset)))
+    return chunks
+
+
+def make_parts(data, chunk_size, uploads):
+    # Returns the (digest, length) of every chunk of data, adding the chunks
+    # to uploads
+    view = serialization.sliceable(data)
+    parts = []
+    for offset, length in split(data, chunk_size):
+        chunk = view[offset : offset + length]
+        chunk_digest = digest(chunk)
+        uploads[chunk_digest] = chunk
+        parts.append((chunk_digest, length))
+    return tuple(parts)
+
+
+class ChunkIndex:
+    # Chunks known to be stored in one bucket or directory, shared by every
+    # instance in the process storing there. Chunks get in here when
+    # uploaded, when found by a HEAD request, or when a restored manifest
+    # refers to them, and are not checked again.
+
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, chunk_digest):
+        with self._lock:
+            return chunk_digest in self._known
+
+    def add(self, chunk_digests):
+        with self._lock:
+            self._known.update(chunk_digests)
+
+    def discard(self, chunk_digests):
+        with self._lock:
+            self._known.difference_update(chunk_digests)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_for(storage):
+    # Chunks known in one place say nothing about another, so each location
+    # chunks are stored in has an index of its own. Backends without one,
+    # e.g. in-memory stores, keep theirs to themselves.
+    location = storage.path(CHUNK_PREFIX)
+    with _indexes_lock:
+        if location is None:
+            if getattr(storage, "chunk_index", None) is None:
+                storage.chunk_index = ChunkIndex()
+            return storage.chunk_index
+        return _indexes.setdefault(location, ChunkIndex())
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import boto3 as boto
+from boto3.s3.transfer import TransferConfig as S3TransferConfig
+from botocore.config import Config
+
+from .transfer import DEFAULT_CONCURRENCY, DEFAULT_PART_SIZE
+
+# One boto session and one client per service, shared by everything in the
+# process, dalmatian and roger alike. Nothing is created until first used, so
+# importing a module costs no session setup, and every thread draws on the
+# same connection pool instead of each object opening its own.
+#
+# Clients are safe to share between threads, but resources and sessions are
+# not, so resources are created per thread. A forked child starts over with
+# clients of its own, since it must not share its parent's connections.
+
+# Enough connections for several transfers running at full concurrency, e.g.
+# a background checkpoint alongside a prefetch. urllib3 opens them as needed.
+DEFAULT_MAX_POOL_CONNECTIONS = 8 * DEFAULT_CONCURRENCY
+# Fail stalled connections rather than leave a transfer hanging on them
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_local = threading.local()
+_max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+
+
+def _config():
+    return Config(
+        max_pool_connections=_max_pool_connections,
+        # Keeps idle pooled connections from being dropped between checkpoints
+        tcp_keepalive=True,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+    )
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto.session.Session()
+    return _session
+
+
+def client(service):
+    # Lock-free once the client exists, since this is called per request
+    found = _clients.get(service)
+    if found is not None:
+        return found
+    with _lock:
+        if service not in _clients:
+            _clients[service] = _get_session().client(service, config=_config())
+        return _clients[service]
+
+
+def resource(service):
+    resources = getattr(_local, "resources", None)
+    if resources is None:
+        resources = _local.resources = {}
+    if service not in resources:
+        with _lock:
+            resources[service] = _get_session().resource(service, config=_config())
+    return resources[service]
+
+
+def reserve_connections(count):
+    # Grows the connection pool of clients to at least count connections.
+    # Clients are built again on next use, and ones already handed out keep
+    # working.
+    global _max_pool_connections
+    with _lock:
+        if count <= _max_pool_connections:
+            return
+        _max_pool_connections = count
+        _clients.clear()
+
+
+def s3_transfer_config(part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    # For boto's managed transfers, e.g. Bucket.upload_file, which otherwise
+    # use 8MB parts and at most 10 threads
+    return S3TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=concurrency,
+        use_threads=True,
+    )
+
+
+def reset():
+    # Forgets every client, resource and the session
+    global _session, _lock, _local
+    _lock = threading.Lock()
+    _session = None
+    _clients.clear()
+    _local = threading.local()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
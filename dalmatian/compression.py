@@ -0,0 +1,178 @@
+import io
+import struct
+import zlib
+
+from .serialization import buffers_of, sliceable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Stored objects may be compressed. Compressed objects start with a small
+# header naming the compressor and the uncompressed size, anything else is
+# stored as is:
+#
+#   MAGIC | compressor code | uncompressed size | compressed stream
+
+MAGIC = b"DLMX"
+_HEADER = struct.Struct("<4sBQ")
+
+# Compression is skipped for objects whose first SAMPLE_SIZE bytes do not
+# shrink below MAX_RATIO of their size. Float weights rarely compress, and are
+# not worth the CPU time.
+SAMPLE_SIZE = 1024 * 1024
+MAX_RATIO = 0.9
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class Compressor:
+    def __init__(self, name, code, default_level, compressobj, decompressobj):
+        self.name = name
+        self.code = code
+        self.default_level = default_level
+        self.compressobj = compressobj
+        self.decompressobj = decompressobj
+
+
+class _LZ4Compressor:
+    def __init__(self, level):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._started = False
+
+    def compress(self, data):
+        prefix = b""
+        if not self._started:
+            prefix = self._compressor.begin()
+            self._started = True
+        return prefix + self._compressor.compress(data)
+
+    def flush(self):
+        return self.compress(b"") + self._compressor.flush()
+
+
+class _LZ4Decompressor:
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+class _ZstdDecompressor:
+    def __init__(self):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(bytes(data))
+
+
+COMPRESSORS = {}
+_BY_CODE = {}
+
+
+def register_compressor(compressor):
+    assert compressor.code not in _BY_CODE, "Compressor code already in use"
+    COMPRESSORS[compressor.name] = compressor
+    _BY_CODE[compressor.code] = compressor
+
+
+register_compressor(
+    Compressor(
+        "zlib",
+        1,
+        1,
+        lambda level: zlib.compressobj(level),
+        lambda: zlib.decompressobj(),
+    )
+)
+if zstandard is not None:
+    register_compressor(
+        Compressor(
+            "zstd",
+            2,
+            3,
+            lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+            _ZstdDecompressor,
+        )
+    )
+if lz4 is not None:
+    register_compressor(Compressor("lz4", 3, 0, _LZ4Compressor, _LZ4Decompressor))
+
+
+def get_compressor(name):
+    if name is None:
+        return None
+    if name not in COMPRESSORS:
+        raise ValueError(
+            "Unknown or unavailable compressor {}, choose from {}".format(
+                name, ", ".join(sorted(COMPRESSORS))
+            )
+        )
+    return COMPRESSORS[name]
+
+
+def worth_compressing(data, compressor, level=None):
+    if compressor is None:
+        return False
+    sample = sliceable(data)[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    compressobj = compressor.compressobj(_level(compressor, level))
+    compressed = len(compressobj.compress(sample)) + len(compressobj.flush())
+    return compressed < MAX_RATIO * len(sample)
+
+
+def write_compressed(writer, data, compressor, level=None):
+    # Streams data through the compressor into a file-like writer, one chunk
+    # at a time so the compressed copy is never held in memory in full
+    buffers = buffers_of(data)
+    size = sum(len(view) for view in buffers)
+    writer.write(_HEADER.pack(MAGIC, compressor.code, size))
+    compressobj = compressor.compressobj(_level(compressor, level))
+    for view in buffers:
+        for i in range(0, len(view), STREAM_CHUNK_SIZE):
+            writer.write(compressobj.compress(view[i : i + STREAM_CHUNK_SIZE]))
+    writer.write(compressobj.flush())
+
+
+def compress(data, compressor, level=None):
+    stream = io.BytesIO()
+    write_compressed(stream, data, compressor, level)
+    return stream.getvalue()
+
+
+def decompress(data):
+    # Returns data untouched unless it is a compressed object
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        return data
+    _, code, size = _HEADER.unpack_from(data, 0)
+    if code not in _BY_CODE:
+        raise ValueError(
+            "Object was compressed with compressor {}, which is not available."
+            " Check if zstandard or lz4 is installed.".format(code)
+        )
+    decompressobj = _BY_CODE[code].decompressobj()
+    view = memoryview(data)
+    output = bytearray(size)
+    offset = 0
+    for i in range(_HEADER.size, len(view), STREAM_CHUNK_SIZE):
+        chunk = decompressobj.decompress(view[i : i + STREAM_CHUNK_SIZE])
+        output[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    if hasattr(decompressobj, "flush"):
+        chunk = decompressobj.flush()
+        output[offset : offset + len(chunk)] = chunk
+        offset += len(chunk)
+    if offset != size:
+        raise ValueError("Decompressed {} of {} bytes".format(offset, size))
+    return output
+
+
+def _level(compressor, level):
+    return compressor.default_level if level is None else level
@@ -1,7 +1,58 @@
+import _thread
+import collections
 import os
-import boto3 as boto
 import pickle
-import copy
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import clients, profiling, serialization
+from .chunks import chunk_name, index_for, make_parts, parse_chunk_name
+from .compression import decompress, get_compressor, worth_compressing, write_compressed
+from .delta import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_FULL_EVERY,
+    MAX_DELTA_RATIO,
+    apply_delta,
+    changed_chunks,
+    chunk_digests,
+    make_delta,
+)
+from .distributed import (
+    COORDINATOR,
+    DEFAULT_TIMEOUT as DEFAULT_DISTRIBUTED_TIMEOUT,
+    merge,
+    owner_by_hash,
+    rank_manifest_name,
+    wait_for,
+)
+from .forking import fork_call
+from .manifest import CorruptionError, Manifest, Shard, digest
+from .transfer import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PART_SIZE,
+    MultipartWriter,
+    TransferConfig,
+    ResumableUploads,
+    TransferError,
+    download,
+    open_reader,
+)
+from .interruption import DEFAULT_INTERVAL, METADATA_ENDPOINT, InterruptionWatcher
+from .params import LazyValue, ParamsView, resolve
+from .profiling import JsonlLog, Profile, StatsdClient, prometheus_exporter
+from .retention import RetentionPolicy
+from .retry import DEFAULT_MAX_ATTEMPTS, Retrier, RetryError
+from .scheduler import (
+    DEFAULT_MAX_INTERVAL,
+    DEFAULT_MIN_INTERVAL,
+    CheckpointScheduler,
+    hazard_from_price_history,
+)
+from .staging import StagingArea
+from .storage import open_storage
+from .uploader import BackgroundUploader, CheckpointHandle
 
 ###### For testing ######
 DEFAULT_INSTANCE_NAME = "amazing-artichoke"
@@ -9,64 +60,338 @@ DEFAULT_INSTANCE_NAME = "amazing-artichoke"
 #########################
 
 
+# Operations are retried this many times on top of the retries of each request
+DEFAULT_OPERATION_ATTEMPTS = 3
+# Profiles of the most recent saves and restores kept for profiles()
+PROFILE_HISTORY = 100
+# An emergency checkpoint gives checkpoints already in flight this long to
+# finish, out of the two minutes an interruption notice gives, and only
+# serializes watched parameters and those stored in less than this size.
+# Shutting down after it waits at most EMERGENCY_CLOSE_TIMEOUT for the
+# checkpoints it abandoned.
+EMERGENCY_FLUSH_TIMEOUT = 30
+EMERGENCY_CLOSE_TIMEOUT = 5
+EMERGENCY_MAX_PARAM_SIZE = 4 * 1024 * 1024
+TRANSFER_ERRORS = (TransferError, RetryError)
+# Keys of the manifests of any instance: the latest, kept versions, and those
+# ranks store before a checkpoint is committed
+MANIFEST_KEY = re.compile(r"[^/]+-state/(manifest|versions/\d+|ranks/\d+/\d+)")
+
 instance = None
 watch_set = {}
+interruption_watcher = None
 
 
 class Instance:
-    def __init__(self, instance_name):
+    def __init__(
+        self,
+        instance_name,
+        part_size=DEFAULT_PART_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        delta_chunk_size=DEFAULT_CHUNK_SIZE,
+        full_every=DEFAULT_FULL_EVERY,
+        codec="auto",
+        compression=None,
+        compression_level=None,
+        staging_dir=None,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        operation_attempts=DEFAULT_OPERATION_ATTEMPTS,
+        lazy=False,
+        prefetch=(),
+        retention=None,
+        step=None,
+        chunk_store=False,
+        storage=None,
+        profile_hooks=(),
+        profile_log=None,
+        statsd=None,
+        prometheus_port=None,
+        hazard_rate=None,
+        price_history=None,
+        max_price=None,
+        min_checkpoint_interval=DEFAULT_MIN_INTERVAL,
+        max_checkpoint_interval=DEFAULT_MAX_INTERVAL,
+        rank=None,
+        world_size=None,
+        owner=owner_by_hash,
+        distributed_timeout=DEFAULT_DISTRIBUTED_TIMEOUT,
+        max_pool_connections=None,
+    ):
         self.name = instance_name
-        self.s3_client = boto.client("s3")
-        self.ec2_client = boto.client("ec2")
+        self.transfer_config = TransferConfig(part_size, concurrency)
+        # Transfers share the process-wide client, whose pool should have a
+        # connection for every thread that can be transferring at once
+        clients.reserve_connections(
+            max_pool_connections
+            or clients.DEFAULT_MAX_POOL_CONNECTIONS * concurrency // DEFAULT_CONCURRENCY
+        )
+        self.delta_chunk_size = delta_chunk_size
+        self.full_every = full_every
+        self.chunk_store = chunk_store
+        self.codec = serialization.get_codec(codec)
+        self.compressor = get_compressor(compression)
+        self.compression_level = compression_level
+        self.retrier = Retrier(max_attempts=max_attempts)
+        self.resumable = ResumableUploads()
+        self.operation_attempts = operation_attempts
+        self.storage = open_storage(storage)
+        self.chunk_index = index_for(self.storage)
+        self.uploader = None
+
+        # In a distributed job each rank stores the parameters owner(key,
+        # world_size) assigns to it, and rank 0 commits the checkpoint
+        self.rank = rank or 0
+        self.world_size = world_size or 1
+        self.owner = owner
+        self.distributed_timeout = distributed_timeout
 
-        s3 = boto.resource("s3")
-        self.bucket = s3.Bucket("dalmatian")
+        self.staging = None
+        if staging_dir is not None:
+            staging_name = instance_name
+            if self.world_size > 1:
+                staging_name = "{}-rank-{}".format(instance_name, self.rank)
+            self.staging = StagingArea(staging_dir, staging_name)
+        self._staging_lock = threading.Lock()
 
+        self._parameters_shared = False
+        self.lazy = lazy
+        self._prefetch_keys = prefetch
+        self._prefetcher = None
+        # The forked checkpoint in progress, if any
+        self._forked = None
+        self._fork_call = None
+        # Checkpoints commit one at a time, and once an emergency checkpoint
+        # has started, any others still in flight are abandoned
+        self._commit_lock = threading.Lock()
+        self._emergency = False
+        # Objects are transferred concurrently, and so are the parts of each,
+        # so every transfer draws on one budget of concurrent requests
+        self._transfer_slots = self.transfer_config.slots()
+        self.retention = retention or RetentionPolicy()
+        self._step = step
+        self._versions = {}
+
+        # Every save and restore is profiled, and the profile handed to each
+        # hook once it is done
+        self.profile_hooks = list(profile_hooks)
+        if profile_log is not None:
+            self.profile_hooks.append(JsonlLog(profile_log))
+        if statsd is not None:
+            self.profile_hooks.append(StatsdClient(statsd))
+        if prometheus_port is not None:
+            self.profile_hooks.append(prometheus_exporter(prometheus_port))
+        self.recent_profiles = collections.deque(maxlen=PROFILE_HISTORY)
+
+        # maybe_checkpoint() spaces checkpoints out by how often interruptions
+        # happen (per hour), given directly or estimated from spot prices
+        if hazard_rate is None and price_history is not None:
+            if max_price is None:
+                raise ValueError("price_history needs the max_price bid on spot")
+            hazard_rate = hazard_from_price_history(price_history, max_price)
+            _log("Estimated {:.3f} interruptions per hour".format(hazard_rate))
+        self.scheduler = CheckpointScheduler(
+            min_interval=min_checkpoint_interval,
+            max_interval=max_checkpoint_interval,
+            **({} if hazard_rate is None else {"hazard_rate": hazard_rate}),
+        )
+
+        profile = Profile("restore", self.name)
         try:
             self.state = {"parameters": {}}
-            self._initialize_storage()
+            with profiling.activate(profile):
+                self._initialize_storage()
             self.storage_initialized = True
         except Exception as e:
-            _log("Failed to initialize storage")
+            _log("Failed to initialize storage: {}".format(e))
             # TODO this needs to fail louder
             self.storage_initialized = False
+        self._finish_profile(profile, self.storage_initialized)
 
     def _initialize_storage(self):
         _log("Initializing storage")
         self.state_name = "{}-state".format(self.name)
+        self.manifest_name = "{}/manifest".format(self.state_name)
+        self.manifest = Manifest()
+        self.staged_manifest = Manifest()
 
-        # Check if data already exists
-        state_keys = [
-            state.key for state in self.bucket.objects.filter(Prefix=self.state_name)
-        ]
+        # Check if data already exists. Older versions of dalmatian stored the
+        # whole state as a single object under state_name, which is still
+        # loaded if no manifest is found.
+        with profiling.current().phase("manifest"):
+            manifest_data = self._read_object(self.manifest_name)
+        remote = None
+        corrupt = False
+        if manifest_data is not None:
+            try:
+                remote = Manifest.decode(manifest_data)
+                self.chunk_index.add(remote.parts())
+            except CorruptionError as e:
+                # Older versions each keep their own copy of their manifest
+                _log("Latest manifest is unreadable: {}".format(e))
+                corrupt = True
+        staged = None
+        if self.staging is not None and self.world_size == 1:
+            # A rank cannot finish a checkpoint on its own, so in distributed
+            # jobs staged checkpoints are only ever drained as they are taken
+            staged = self.staging.read_manifest()
+        if (remote is not None or corrupt) and self._step not in (
+            None,
+            getattr(remote, "sequence", None),
+        ):
+            # Resuming from an earlier version. Its objects are all still
+            # stored, so later checkpoints only upload what changes from it.
+            version = self._read_version(self._step)
+            if version is None:
+                _log("No checkpoint found for step {}".format(self._step))
+                raise KeyError(self._step)
+            _log("Resuming from step {}".format(self._step))
+            if remote is not None:
+                version.history = remote.history
+            remote = version
+            corrupt = False
+            staged = None
+        legacy_size = self.retrier.call(
+            "head_object", self.storage.size, self.state_name
+        )
 
-        if self.state_name in state_keys:
+        # A staged checkpoint newer than the one in S3 was taken just before
+        # the instance stopped, and never finished draining
+        if (
+            staged is not None
+            and (remote is None or staged.sequence > remote.sequence)
+            and self._load_intact(staged)
+        ):
+            _log("Loaded newer state staged on local disk")
+            self.manifest = remote or Manifest()
+            self.staged_manifest = staged
+            self._submit(lambda: self._drain(staged), Profile("drain", self.name))
+        elif remote is not None or corrupt:
             _log("Prior state found, loading state")
-            self._safe_retry(self._get_state)
+            self.manifest = self.staged_manifest = self._load_committed(remote)
+        elif legacy_size is not None:
+            _log("Prior unsharded state found, loading state")
+            if not self._safe_retry(lambda: self._get_legacy_state(legacy_size)):
+                raise TransferError("Failed to load prior state")
         else:  # we need to initialize the state object
             _log("Initializing remote state")
-            self._safe_retry(self._put_state)
+            self._safe_retry(self._put_state, uploads=True)
+            self.staged_manifest = self.manifest
 
         _log("Initializing of storage complete")
 
-    def _bytedata(self):
-        return pickle.dumps(self.state)
+    def _load_intact(self, manifest):
+        # Loads the state a manifest describes, returning False if it turns
+        # out to be corrupt rather than raising
+        try:
+            return self._safe_retry(lambda: self._get_state(manifest))
+        except CorruptionError as e:
+            _log("Checkpoint {} is corrupt: {}".format(manifest.sequence, e))
+            return False
 
-    def _get_state(self):
-        _log("Requesting state from S3")
-        response = self.s3_client.get_object(
-            Bucket=self.bucket.name, Key=self.state_name
-        )
+    def _load_committed(self, latest):
+        # Loads the latest committed checkpoint that is intact, going back
+        # through older versions if needed, and returns its manifest. Raises
+        # if loading failed for other reasons, e.g. an outage, since an older
+        # checkpoint would then lose progress for nothing, and carrying on
+        # with an empty state would commit over the stored one.
+        if latest is not None:
+            candidates = [latest.sequence, *sorted(latest.history, reverse=True)]
+        else:
+            prefix = "{}/versions/".format(self.state_name)
+            listed = self.retrier.call("list_objects", self.storage.list, prefix)
+            candidates = sorted(
+                (int(key[len(prefix) :]) for key in listed), reverse=True
+            )
+        for sequence in dict.fromkeys(candidates):
+            version = latest
+            if latest is None or sequence != latest.sequence:
+                version = self._read_version(sequence)
+                if version is None:
+                    continue
+                _log("Falling back to checkpoint {}".format(sequence))
+            try:
+                if not self._safe_retry(lambda: self._get_state(version)):
+                    raise TransferError(
+                        "Failed to load checkpoint {}".format(sequence)
+                    )
+                return version
+            except CorruptionError as e:
+                _log("Checkpoint {} is corrupt: {}".format(sequence, e))
+        raise CorruptionError("No intact checkpoint found")
 
-        status = response["ResponseMetadata"]["HTTPStatusCode"]
-        if status != 200:
-            _log("Request failed")
-            return False
+    def _shard_name(self, digest):
+        return "{}/shards/{}".format(self.state_name, digest)
+
+    def _version_name(self, sequence):
+        return "{}/versions/{}".format(self.state_name, sequence)
+
+    def _read_version(self, sequence):
+        # Manifests of kept versions are cached once read
+        if sequence not in self._versions:
+            manifest_data = self._read_object(self._version_name(sequence))
+            if manifest_data is None:
+                return None
+            try:
+                self._versions[sequence] = Manifest.decode(manifest_data)
+            except CorruptionError as e:
+                _log("Manifest of step {} is unreadable: {}".format(sequence, e))
+                return None
+        return self._versions[sequence]
 
-        stream = response["Body"]
-        bytedata = stream.read()
+    def _owns(self, key):
+        return self.world_size == 1 or self.owner(key, self.world_size) == self.rank
+
+    def _snapshot(self, emergency=False, stream=False):
+        # Each top-level parameter is serialized separately so that it can be
+        # stored, and skipped when unchanged, on its own. Watched objects are
+        # read at this point, so their current contents are what gets saved.
+        # Emergency snapshots leave large parameters that are not watched as
+        # the last checkpoint stored them.
+        #
+        # With stream set, array data is not copied but stays in the arrays
+        # themselves until uploaded, so only blocking saves, which nothing
+        # changes the state under, can use it.
+        profile = profiling.current()
+        previous = self.manifest
+        if self.staging is not None:
+            previous = self.staged_manifest
+        parameters = {
+            key: value
+            for key, value in {**self.state["parameters"], **watch_set}.items()
+            if self._owns(key)
+        }
+        snapshot = {}
+        for key, value in parameters.items():
+            shard = previous.shards.get(key)
+            if (
+                emergency
+                and key not in watch_set
+                and shard is not None
+                and shard.size > EMERGENCY_MAX_PARAM_SIZE
+            ):
+                snapshot[key] = shard
+                continue
+            if isinstance(value, LazyValue):
+                if not value.loaded:
+                    # Never loaded, so unchanged: the shard stays as it is
+                    snapshot[key] = value.shard
+                    continue
+                value = value.get()
+            with profile.phase("serialize"):
+                if stream:
+                    snapshot[key] = serialization.dumps_segments(value, self.codec)
+                else:
+                    snapshot[key] = serialization.dumps(value, self.codec)
+            profile.add_bytes("serialized", len(snapshot[key]))
+        return snapshot
+
+    def _read_object(self, key):
+        # Returns None if there is no such object
+        return self.retrier.call("get_object", self.storage.get, key)
+
+    def _load(self, load, source):
         try:
-            self.state = pickle.loads(bytedata)
+            return load(source)
         except ModuleNotFoundError as e:
             _log(e.msg)
             _log(
@@ -75,47 +400,1063 @@ class Instance:
                 " local environment."
             )
             raise e
+
+    def _fetch(self, digest, size=None, key=None):
+        # Objects staged on local disk are read from there, skipping the
+        # download, as long as their contents still match their digest
+        profile = profiling.current()
+        if self.staging is not None:
+            with profile.phase("read_staged"):
+                bytedata = self.staging.read_object(digest)
+            if bytedata is not None:
+                return bytedata
+        with profile.phase("download"):
+            if size is None:
+                bytedata = self._read_object(key or self._shard_name(digest))
+                if bytedata is None:
+                    raise CorruptionError("Missing object {}".format(digest))
+            else:
+                try:
+                    bytedata = self._download(digest, size)
+                except Exception as e:
+                    # Backends fail on missing or truncated objects in their
+                    # own ways, which are told apart from an outage by what
+                    # is actually stored
+                    self._check_stored(digest, size)
+                    raise e
+        profile.add_bytes("downloaded", len(bytedata))
+        with profile.phase("decompress"):
+            return decompress(bytedata)
+
+    def _check_stored(self, digest, size):
+        try:
+            stored = self.retrier.call(
+                "head_object", self.storage.size, self._shard_name(digest)
+            )
+        except Exception:
+            return
+        if stored is None:
+            raise CorruptionError("Missing object {}".format(digest))
+        if stored != size:
+            raise CorruptionError(
+                "Object {} is {} bytes, expected {}".format(digest, stored, size)
+            )
+
+    def _download(self, digest, size):
+        return download(
+            self.storage,
+            self._shard_name(digest),
+            size,
+            self.transfer_config,
+            self.retrier,
+            self._transfer_slots,
+        )
+
+    def _get_shard(self, key, shard):
+        return key, self._load_shard(shard)
+
+    def _load_shard(self, shard):
+        # Shards are downloaded into one buffer which arrays are then loaded
+        # from without copying
+        if shard.parts is not None:
+            bytedata = self._assemble_shard(shard)
+        elif shard.deltas:
+            bytedata = self._replay_shard(shard)
+        else:
+            bytedata = self._fetch(shard.digest, shard.base_size)
+            self._verify(bytedata, shard)
+        with profiling.current().phase("deserialize"):
+            return self._load(serialization.loads, bytedata)
+
+    def _lazy_load(self, shard):
+        # Parameters loaded on first access are profiled on their own
+        profile = Profile("load", self.name)
+        loaded = False
+        try:
+            with profiling.activate(profile):
+                value = self._load_shard(shard)
+            loaded = True
+        finally:
+            self._finish_profile(profile, loaded)
+        return value
+
+    def _verify(self, bytedata, shard):
+        with profiling.current().phase("verify"):
+            if digest(bytedata) != shard.digest:
+                raise CorruptionError(
+                    "Shard {} failed verification".format(shard.digest)
+                )
+
+    def _replay_shard(self, shard):
+        # Rebuilds a shard from its base and every delta stacked on it since
+        bytedata = self._fetch(shard.base, shard.base_size)
+        for delta in shard.deltas:
+            delta = self._fetch(delta)
+            with profiling.current().phase("replay"):
+                apply_delta(bytedata, delta)
+        self._verify(bytedata, shard)
+        return bytedata
+
+    def _assemble_shard(self, shard):
+        # Chunks are fetched in parallel straight into place
+        bytedata = bytearray(shard.size)
+        placed = []
+        offset = 0
+        for part_digest, length in shard.parts:
+            placed.append((offset, part_digest, length))
+            offset += length
+
+        def fetch(item):
+            offset, part_digest, length = item
+            chunk = self._fetch(part_digest, key=chunk_name(part_digest))
+            if len(chunk) != length:
+                raise TransferError("Chunk {} has the wrong size".format(part_digest))
+            bytedata[offset : offset + length] = chunk
+
+        with ThreadPoolExecutor(self.transfer_config.concurrency) as executor:
+            list(executor.map(profiling.bind(fetch), placed))
+        self._verify(bytedata, shard)
+        return bytedata
+
+    def _get_state(self, manifest):
+        # Parameters another rank owns are only fetched if they are accessed
+        deferred = {
+            key: LazyValue(shard, self._lazy_load)
+            for key, shard in manifest.shards.items()
+            if self.lazy or not self._owns(key)
+        }
+        if self.lazy:
+            # Only the manifest is needed up front. Parameters are fetched
+            # when first accessed, or ahead of time if asked to prefetch them.
+            _log("Deferring state requests until parameters are accessed")
+            self.state = {"parameters": deferred}
+            self.prefetch(self._prefetch_keys)
+            return True
+
+        _log("Requesting state")
+        try:
+            with ThreadPoolExecutor(self.transfer_config.concurrency) as executor:
+                parameters = dict(
+                    executor.map(
+                        profiling.bind(lambda item: self._get_shard(*item)),
+                        [
+                            item
+                            for item in manifest.shards.items()
+                            if item[0] not in deferred
+                        ],
+                    )
+                )
+        except TRANSFER_ERRORS:
+            _log("Request failed")
+            return False
+        self.state = {"parameters": {**deferred, **parameters}}
+        self.prefetch(self._prefetch_keys)
         _log("Request succeeded")
         return True
 
-    def _put_state(self):
-        _log("Storing state into S3")
-        response = self.s3_client.put_object(
-            Bucket=self.bucket.name, Key=self.state_name, Body=self._bytedata()
+    def _get_legacy_state(self, size):
+        _log("Requesting state from S3")
+        try:
+            with open_reader(
+                self.storage,
+                self.state_name,
+                size,
+                self.transfer_config,
+                self.retrier,
+                self._transfer_slots,
+            ) as stream:
+                self.state = self._load(pickle.load, stream)
+        except TRANSFER_ERRORS:
+            _log("Request failed")
+            return False
+        _log("Request succeeded")
+        return True
+
+    def _put_object(self, key, bytedata, compress=True, check=None):
+        # Returns the number of bytes stored, which differs from the size of
+        # bytedata when it is compressed. check is called before each part
+        # is uploaded, and may raise to stop the upload.
+        profile = profiling.current()
+        compressor = self.compressor if compress else None
+        writer = _UploadTimer(
+            MultipartWriter(
+                self.storage,
+                key,
+                self.transfer_config,
+                self.retrier,
+                self.resumable,
+                check,
+                self._transfer_slots,
+            ),
+            profile,
+        )
+        try:
+            # Parts are uploaded as they are written, so uploads are timed as
+            # a phase nested inside compression
+            with profile.phase("compress"):
+                if worth_compressing(bytedata, compressor, self.compression_level):
+                    write_compressed(
+                        writer, bytedata, compressor, self.compression_level
+                    )
+                else:
+                    for buffer in serialization.buffers_of(bytedata):
+                        writer.write(buffer)
+                writer.close()
+        except TRANSFER_ERRORS as e:
+            # Part failures mostly come out of write, and the next attempt
+            # resumes from the parts that made it
+            writer.suspend()
+            raise e
+        except BaseException:
+            writer.abort()
+            raise
+        profile.add_bytes("uploaded", writer.bytes_written)
+        profile.add_count("objects")
+        return writer.bytes_written
+
+    def _object_exists(self, key):
+        return self.retrier.call("head_object", self.storage.size, key) is not None
+
+    def _put_chunk(self, chunk_digest, read_object, compress=True, check=None):
+        # Chunks already in the bucket, e.g. uploaded by another instance
+        # starting from the same weights, are not uploaded again
+        profile = profiling.current()
+        if chunk_digest in self.chunk_index:
+            profile.add_count("chunks_known")
+            return
+        key = chunk_name(chunk_digest)
+        with profile.phase("chunk_lookup"):
+            exists = self._object_exists(key)
+        if exists:
+            profile.add_count("chunks_known")
+        else:
+            self._put_object(key, read_object(chunk_digest), compress, check)
+        self.chunk_index.add((chunk_digest,))
+
+    def _plan_shard(self, previous, bytedata, full, uploads):
+        # Works out how to store a shard given what is already stored for its
+        # key, adding any objects that need uploading to uploads
+        shard_digest = digest(bytedata)
+        if (
+            previous is not None
+            and previous.digest == shard_digest
+            and not (full and previous.deltas)
+        ):
+            return previous
+
+        if self.chunk_store:
+            return Shard(
+                shard_digest,
+                len(bytedata),
+                parts=make_parts(bytedata, self.delta_chunk_size, uploads),
+            )
+
+        chunks = None
+        if len(bytedata) > self.delta_chunk_size:
+            chunks = chunk_digests(bytedata, self.delta_chunk_size)
+        if (
+            not full
+            and chunks is not None
+            and previous is not None
+            and previous.chunks is not None
+            and len(previous.deltas) < self.full_every
+        ):
+            changed = changed_chunks(previous.chunks, chunks)
+            if len(changed) * self.delta_chunk_size <= MAX_DELTA_RATIO * len(bytedata):
+                delta = make_delta(bytedata, changed, self.delta_chunk_size)
+                delta_digest = digest(delta)
+                uploads[delta_digest] = delta
+                return Shard(
+                    shard_digest,
+                    len(bytedata),
+                    base=previous.base,
+                    base_size=previous.base_size,
+                    deltas=previous.deltas + (delta_digest,),
+                    chunks=chunks,
+                )
+
+        uploads[shard_digest] = bytedata
+        return Shard(shard_digest, len(bytedata), chunks=chunks)
+
+    def _plan_state(self, snapshot, full, previous, metrics=None):
+        with profiling.current().phase("plan"):
+            return self._plan_manifest(snapshot, full, previous, metrics)
+
+    def _plan_manifest(self, snapshot, full, previous, metrics):
+        # Returns the manifest for a snapshot, following on from the previous
+        # manifest, along with the new objects it needs. Sequence numbers keep
+        # going up even after resuming from an earlier version.
+        manifest = Manifest(
+            sequence=max([previous.sequence, *previous.history]) + 1,
+            metadata={"time": time.time(), "metrics": dict(metrics or {})},
+            history=previous.history,
         )
+        stored = previous.digests() | previous.parts()
+        objects = {}
+        for key, bytedata in snapshot.items():
+            if isinstance(bytedata, Shard):
+                manifest.shards[key] = bytedata
+                continue
+            manifest.shards[key] = self._plan_shard(
+                previous.shards.get(key), bytedata, full, objects
+            )
+        objects = {
+            object_digest: bytedata
+            for object_digest, bytedata in objects.items()
+            if object_digest not in stored
+        }
+        return manifest, objects
 
-        status = response["ResponseMetadata"]["HTTPStatusCode"]
-        if status != 200:
+    def _put_state(self, snapshot=None, full=False, metrics=None):
+        # Unless full is set, shards with a stored base only upload the chunks
+        # that changed since the last checkpoint. full folds every delta chain
+        # back into a new base.
+        _log("Storing state into S3")
+        if snapshot is None:
+            snapshot = self._snapshot(stream=True)
+        manifest, objects = self._plan_state(snapshot, full, self.manifest, metrics)
+        return self._sync(manifest, objects.__getitem__)
+
+    def _sync(self, manifest, read_object, emergency=False):
+        # Uploads every object the manifest refers to that is not in S3 yet,
+        # reading their contents with read_object, then the manifest itself.
+        # Versions the retention policy no longer keeps are dropped after. In
+        # a distributed job the manifest only covers this rank's parameters,
+        # and is committed along with those of the other ranks. Emergency
+        # checkpoints are uploaded uncompressed, and leave cleaning up to the
+        # next garbage collection.
+        #
+        # Uploads stop as soon as the checkpoint could no longer be committed,
+        # so that one an emergency checkpoint abandoned does not compete with
+        # it for bandwidth.
+        sequence = manifest.sequence
+        try:
+            self._upload(
+                manifest,
+                read_object,
+                compress=not emergency,
+                check=lambda: self._check_current(sequence, emergency),
+            )
+            if self.world_size > 1:
+                manifest = self._gather(manifest)
+        except TRANSFER_ERRORS:
             _log("Storage failed")
             return False
+
+        with self._commit_lock:
+            self._check_current(sequence, emergency)
+            stored = self.manifest.digests()
+            if self.rank == COORDINATOR:
+                try:
+                    dropped = self._commit(manifest)
+                except TRANSFER_ERRORS:
+                    _log("Storage failed")
+                    return False
+            self.manifest = manifest
+            self._versions[manifest.sequence] = manifest
+            if self.rank == COORDINATOR and not emergency:
+                # Only the coordinator cleans up, having the full picture
+                with profiling.current().phase("cleanup"):
+                    self._drop_versions(stored - manifest.digests(), dropped)
+                    if self.world_size > 1:
+                        self._drop_rank_manifests(manifest.sequence)
         _log("Storage succeeded")
         return True
 
-    def _erase_state(self):
-        _log("Erasing state from S3")
-        response = self.s3_client.delete_object(
-            Bucket=self.bucket.name, Key=self.state_name
+    def _check_current(self, sequence, emergency):
+        # A checkpoint planned before another was committed would undo it,
+        # and delete objects it refers to. Once an emergency checkpoint is
+        # underway, no other may be committed either.
+        stale = sequence <= self.manifest.sequence
+        if stale or (self._emergency and not emergency):
+            raise _Superseded()
+
+    def _upload(self, manifest, read_object, compress=True, check=None):
+        stored = self.manifest.digests()
+        stored_sizes = {
+            shard.base: shard.base_size for shard in self.manifest.shards.values()
+        }
+        uploads = sorted(manifest.digests() - stored)
+        parts = sorted(manifest.parts() - self.manifest.parts())
+        _log(
+            "Uploading {} objects and up to {} chunks for {} shards".format(
+                len(uploads), len(parts), len(manifest.shards)
+            )
+        )
+
+        with ThreadPoolExecutor(self.transfer_config.concurrency) as executor:
+            stored_sizes.update(
+                zip(
+                    uploads,
+                    executor.map(
+                        profiling.bind(
+                            lambda object_digest: self._put_object(
+                                self._shard_name(object_digest),
+                                read_object(object_digest),
+                                compress,
+                                check,
+                            )
+                        ),
+                        uploads,
+                    ),
+                )
+            )
+            list(
+                executor.map(
+                    profiling.bind(
+                        lambda part_digest: self._put_chunk(
+                            part_digest, read_object, compress, check
+                        )
+                    ),
+                    parts,
+                )
+            )
+        for shard in manifest.shards.values():
+            if shard.parts is None:
+                shard.base_size = stored_sizes[shard.base]
+
+    def _commit(self, manifest):
+        # Stores the manifest along with the history of the versions the
+        # retention policy keeps, and returns the versions it dropped. Each
+        # version keeps its own copy of the manifest. The latest manifest
+        # goes last, so it only ever refers to stored shards.
+        history = dict(self.manifest.history)
+        history[manifest.sequence] = manifest.metadata
+        keep = self.retention.retain(history) | {manifest.sequence}
+        manifest.history = {sequence: history[sequence] for sequence in sorted(keep)}
+        with profiling.current().phase("manifest"):
+            manifest_data = manifest.encode()
+            self.retrier.call(
+                "put_object",
+                self.storage.put,
+                self._version_name(manifest.sequence),
+                manifest_data,
+            )
+            self.retrier.call(
+                "put_object", self.storage.put, self.manifest_name, manifest_data
+            )
+        return set(history) - keep
+
+    def _gather(self, manifest):
+        # Stores this rank's manifest, then waits for the rest of the
+        # checkpoint: the coordinator for the manifests of every rank, which
+        # it merges, and the other ranks for the coordinator to commit them
+        sequence = manifest.sequence
+        self.retrier.call(
+            "put_object",
+            self.storage.put,
+            rank_manifest_name(self.state_name, sequence, self.rank),
+            manifest.encode(),
+        )
+        with profiling.current().phase("gather"):
+            if self.rank == COORDINATOR:
+                gathered = wait_for(
+                    lambda: self._rank_manifests(sequence), self.distributed_timeout
+                )
+            else:
+                gathered = wait_for(
+                    lambda: self._committed(sequence), self.distributed_timeout
+                )
+        if gathered is None:
+            raise TransferError(
+                "Timed out waiting for all ranks to store checkpoint {}".format(
+                    sequence
+                )
+            )
+        if self.rank != COORDINATOR:
+            return gathered
+        return merge(
+            gathered, sequence, dict(manifest.metadata, world_size=self.world_size)
+        )
+
+    def _rank_manifests(self, sequence):
+        # Every rank's manifest for a checkpoint, or None until all are in
+        prefix = rank_manifest_name(self.state_name, sequence)
+        listed = self.retrier.call("list_objects", self.storage.list, prefix)
+        ranks = range(self.world_size)
+        if any(prefix + str(rank) not in listed for rank in ranks):
+            return None
+        return {
+            rank: Manifest.decode(self._read_object(prefix + str(rank)))
+            for rank in ranks
+        }
+
+    def _committed(self, sequence):
+        # The latest manifest once it is at least as new as sequence
+        manifest_data = self._read_object(self.manifest_name)
+        if manifest_data is None:
+            return None
+        manifest = Manifest.decode(manifest_data)
+        if manifest.sequence < sequence:
+            return None
+        return manifest
+
+    def _drop_rank_manifests(self, sequence):
+        self._delete_objects(
+            list(
+                self.retrier.call(
+                    "list_objects",
+                    self.storage.list,
+                    rank_manifest_name(self.state_name, sequence),
+                )
+            )
         )
 
-        status = response["ResponseMetadata"]["HTTPStatusCode"]
-        if status != 204:
-            _log("Erasure failed")
+    def _stage_state(self, snapshot, full=False, metrics=None):
+        # Writes the checkpoint durably to local disk. It still needs to be
+        # drained to S3 afterwards.
+        _log("Staging state on local disk")
+        with self._staging_lock:
+            manifest, objects = self._plan_state(
+                snapshot, full, self.staged_manifest, metrics
+            )
+            profile = profiling.current()
+            with profile.phase("stage"):
+                for object_digest, bytedata in objects.items():
+                    self.staging.write_object(object_digest, bytedata)
+                    profile.add_bytes("staged", len(bytedata))
+                self.staging.write_manifest(manifest)
+            self.staged_manifest = manifest
+        _log("Staging succeeded")
+        return manifest
+
+    def _read_staged(self, object_digest):
+        bytedata = self.staging.read_object(object_digest)
+        if bytedata is None:
+            raise TransferError("Staged object {} is missing".format(object_digest))
+        return bytedata
+
+    def _drain(self, manifest, emergency=False):
+        _log("Draining staged state into S3")
+        if not self._sync(manifest, self._read_staged, emergency):
             return False
+        # Staged objects are only kept while a manifest still refers to them
+        with self._staging_lock:
+            keep = set()
+            for kept in (self.staged_manifest, manifest):
+                keep |= kept.digests() | kept.parts()
+            self.staging.delete_objects(self.staging.object_digests() - keep)
+        return True
+
+    def _referenced_digests(self):
+        # Every object some kept version refers to
+        referenced = self.manifest.digests()
+        for sequence in self.manifest.history:
+            version = self._read_version(sequence)
+            if version is not None:
+                referenced |= version.digests()
+        return referenced
+
+    def _drop_versions(self, candidates, dropped):
+        # Deletes the manifests of dropped versions, and the candidate objects
+        # plus those the dropped versions refer to, unless a kept version
+        # still needs them
+        candidates = set(candidates)
+        for sequence in dropped:
+            version = self._read_version(sequence)
+            if version is not None:
+                candidates |= version.digests()
+        garbage = candidates - self._referenced_digests()
+        self._delete_objects(
+            [self._shard_name(digest) for digest in garbage]
+            + [self._version_name(sequence) for sequence in dropped]
+        )
+        for sequence in dropped:
+            self._versions.pop(sequence, None)
+
+    def _delete_objects(self, keys):
+        # The S3 backend batches these into DeleteObjects calls
+        if keys:
+            self.retrier.call("delete_objects", self.storage.delete, keys)
+
+    def _pending_checkpoints(self):
+        # Sequences of distributed checkpoints some rank has stored its
+        # manifest for, that have not been committed yet
+        ranks_prefix = "{}/ranks/".format(self.state_name)
+        listed = self.retrier.call("list_objects", self.storage.list, ranks_prefix)
+        sequences = {int(key[len(ranks_prefix) :].split("/")[0]) for key in listed}
+        return sorted(
+            sequence for sequence in sequences if sequence > self.manifest.sequence
+        )
+
+    def _collect_garbage(self):
+        _log("Collecting garbage")
+        referenced = {self._shard_name(d) for d in self._referenced_digests()}
+        kept = {self._version_name(sequence) for sequence in self.manifest.history}
+        keys = [
+            key
+            for prefix in ("shards/", "versions/")
+            for key in self.retrier.call(
+                "list_objects",
+                self.storage.list,
+                "{}/{}".format(self.state_name, prefix),
+            )
+        ]
+        garbage = [key for key in keys if key not in referenced and key not in kept]
+        # Manifests of ranks whose checkpoint was committed, or abandoned
+        ranks_prefix = "{}/ranks/".format(self.state_name)
+        garbage += [
+            key
+            for key in self.retrier.call(
+                "list_objects", self.storage.list, ranks_prefix
+            )
+            if int(key[len(ranks_prefix) :].split("/")[0]) <= self.manifest.sequence
+        ]
+        self._delete_objects(garbage)
+        _log("Deleted {} unreferenced objects".format(len(garbage)))
+        return True
+
+    def _collect_chunks(self):
+        # Chunks are shared by every instance in the bucket, so the ones
+        # still needed are worked out from the manifests of all of them
+        _log("Collecting unreferenced chunks")
+        referenced = self.staged_manifest.parts() | self.manifest.parts()
+        listed = self.retrier.call("list_objects", self.storage.list, "")
+        for key in listed:
+            if not MANIFEST_KEY.fullmatch(key):
+                continue
+            manifest_data = self._read_object(key)
+            if manifest_data is None:
+                continue
+            # A manifest that cannot be read could refer to any chunk, so
+            # this raises rather than deleting them
+            referenced |= Manifest.decode(manifest_data).parts()
+        garbage = {
+            digest for digest in map(parse_chunk_name, listed) if digest is not None
+        } - referenced
+        # Forgotten first, so no checkpoint skips uploading one being deleted
+        self.chunk_index.discard(garbage)
+        self._delete_objects([chunk_name(digest) for digest in sorted(garbage)])
+        _log("Deleted {} unreferenced chunks".format(len(garbage)))
+        return True
+
+    def _erase_state(self):
+        _log("Erasing state from storage")
+        for key, (upload_id, _) in self.resumable.pop_all().items():
+            self.retrier.call(
+                "abort_multipart_upload", self.storage.abort_multipart, key, upload_id
+            )
+        keys = self.retrier.call(
+            "list_objects", self.storage.list, self.state_name + "/"
+        )
+        self._delete_objects(list(keys) + [self.state_name])
+        self.manifest = Manifest()
+        self.staged_manifest = Manifest()
+        if self.staging is not None:
+            self.staging.erase()
         _log("Erasure succeeded")
         return True
 
-    def _safe_retry(self, method):
-        # TODO This method doesn't actually retry anything right now
-        method()
+    def _abandon_in_flight(self):
+        # Stops checkpoints still in flight from committing, so they can
+        # neither collide with an emergency checkpoint nor delete what it
+        # refers to. Any commit already underway finishes first.
+        with self._commit_lock:
+            self._emergency = True
+        if self._forked is not None and not self._forked.done():
+            self._fork_call.kill()
+            self._forked.wait()
+            # The child may have committed or staged a checkpoint before it
+            # was killed, without getting to report back
+            manifest_data = self._read_object(self.manifest_name)
+            try:
+                latest = Manifest.decode(manifest_data) if manifest_data else None
+            except CorruptionError:
+                latest = None
+            if latest is not None and latest.sequence > self.manifest.sequence:
+                self.manifest = latest
+            if self.staging is not None:
+                staged = self.staging.read_manifest()
+                if staged is not None and (
+                    staged.sequence > self.staged_manifest.sequence
+                ):
+                    self.staged_manifest = staged
+            else:
+                self.staged_manifest = self.manifest
+
+    def _check_initialized(self):
+        # Without the stored state loaded, a save would commit an empty
+        # manifest over it and garbage collection would delete all of it
+        assert self.storage_initialized, "Storage not initialized, nothing is saved"
+
+    def _safe_retry(self, method, uploads=False):
+        # Individual requests are already retried by the retrier. This
+        # retries whole operations that still failed, e.g. after a long
+        # outage, and any multipart uploads they started resume from the
+        # parts that made it. With uploads set, uploads still suspended at
+        # the end are aborted, since no later checkpoint writes the same
+        # objects to resume them, and S3 keeps their parts until then.
+        try:
+            for attempt in range(1, self.operation_attempts + 1):
+                try:
+                    if method():
+                        return True
+                except TRANSFER_ERRORS as e:
+                    _log("Attempt {} failed: {}".format(attempt, e))
+                except _Superseded:
+                    _log("Abandoned in favour of a newer checkpoint")
+                    return False
+                if attempt < self.operation_attempts:
+                    self.retrier.sleep(self.retrier.delay(attempt))
+            _log("Giving up after {} attempts".format(self.operation_attempts))
+            return False
+        finally:
+            if uploads:
+                self._abort_suspended()
+
+    def _abort_suspended(self):
+        for key, (upload_id, _) in self.resumable.pop_all().items():
+            try:
+                self.retrier.call(
+                    "abort_multipart_upload",
+                    self.storage.abort_multipart,
+                    key,
+                    upload_id,
+                )
+            except TRANSFER_ERRORS as e:
+                _log("Failed to abort upload of {}: {}".format(key, e))
+
+    def _finish_profile(self, profile, ok):
+        profile.finish(ok)
+        if ok and self.manifest is not None:
+            profile.sequence = self.manifest.sequence
+        self.recent_profiles.append(profile)
+        for hook in list(self.profile_hooks):
+            try:
+                hook(profile)
+            except Exception as e:
+                _log("Profile hook failed: {}".format(e))
+
+    def _submit(self, method, profile):
+        def upload():
+            saved = False
+            try:
+                with profiling.activate(profile):
+                    saved = self._safe_retry(method, uploads=True)
+            finally:
+                self._finish_profile(profile, saved)
+            if not saved:
+                raise IOError("Failed to store state for {}".format(self.name))
+
+        if self.uploader is None:
+            self.uploader = BackgroundUploader()
+        return self.uploader.submit(upload)
+
+    def _background_save(self, full=False, metrics=None):
+        # The state is pickled before handing off, so the training loop is
+        # free to keep mutating it while the upload happens. When staging,
+        # the checkpoint is on local disk by the time this returns.
+        #
+        # Each checkpoint follows on from the manifest of the last, so this
+        # one waits for a forked checkpoint still in progress before planning.
+        # When staging that happens here, and otherwise in the background.
+        forked = self._forked
+        profile = Profile("save", self.name)
+        with profiling.activate(profile):
+            snapshot = self._snapshot()
+            if self.staging is not None:
+                if forked is not None:
+                    forked.wait()
+                manifest = self._stage_state(snapshot, full, metrics)
+                return self._submit(lambda: self._drain(manifest), profile)
+
+        def put():
+            if forked is not None:
+                forked.wait()
+            return self._put_state(snapshot, full, metrics)
+
+        return self._submit(put, profile)
+
+    def _forked_save(self, full=False, metrics=None):
+        # A forked child serializes and uploads the state as it was at the
+        # fork, so training only pauses for the fork itself. Only one forked
+        # checkpoint runs at a time, so that each follows on from the
+        # manifest of the last.
+        self.flush()
+        profile = Profile("save", self.name)
+        with profile.phase("fork"):
+            call = fork_call(lambda: self._child_save(profile, full, metrics))
+        self._fork_call = call
+
+        def collect():
+            saved = False
+            child_profile = profile
+            try:
+                saved, manifest_data, staged_data, child_profile = call.result()
+                child_profile.phases["fork"] = profile.phases["fork"]
+                if saved:
+                    manifest = Manifest.decode(manifest_data)
+                    self.chunk_index.add(manifest.parts())
+                    self._versions[manifest.sequence] = manifest
+                    self.manifest = manifest
+                if staged_data is not None:
+                    self.staged_manifest = Manifest.decode(staged_data)
+            finally:
+                self._finish_profile(child_profile, saved)
+            if not saved:
+                raise IOError("Failed to store state for {}".format(self.name))
+
+        handle = CheckpointHandle(collect)
+        threading.Thread(
+            target=handle._run, name="dalmatian-fork-{}".format(call.pid), daemon=True
+        ).start()
+        self._forked = handle
+        return handle
+
+    def _child_save(self, profile, full, metrics):
+        # Runs in the forked child, where no other threads carried over
+        self.uploader = None
+        self._prefetcher = None
+        self._forked = None
+        self._fork_call = None
+        self._commit_lock = threading.Lock()
+        self._transfer_slots = self.transfer_config.slots()
+        self.storage.after_fork()
+        saved = self._save_now(profile, full, metrics)
+        staged = self.staged_manifest
+        return (
+            saved,
+            self.manifest.encode(),
+            None if staged is None else staged.encode(),
+            profile,
+        )
+
+    def _save_now(self, profile, full, metrics):
+        if self.staging is not None:
+            # Staging does not need to wait for uploads in flight
+            with profiling.activate(profile):
+                manifest = self._stage_state(self._snapshot(), full, metrics)
+            self.flush()
+            with profiling.activate(profile):
+                return self._safe_retry(lambda: self._drain(manifest), uploads=True)
+        self.flush()
+        with profiling.activate(profile):
+            return self._safe_retry(
+                lambda: self._put_state(full=full, metrics=metrics), uploads=True
+            )
 
     ### Public Interface ###
 
-    def save(self):
+    def save(self, blocking=True, full=False, metrics=None, fork=False):
+        # metrics, e.g. {"loss": 0.1}, are recorded with the checkpoint for
+        # retention policies that keep the best versions. fork=True takes
+        # the checkpoint in a forked process, and returns a handle like
+        # blocking=False does.
+        self._check_initialized()
         _log("Initializing save")
-        self._safe_retry(self._put_state)
-        _log("Save complete")
+        if fork and not (hasattr(os, "fork") and self.storage.shared):
+            _log("Cannot fork to checkpoint here, checkpointing in the background")
+            fork, blocking = False, False
+        if fork:
+            handle = self._forked_save(full, metrics)
+            _log("Save forked")
+            return handle
+        if not blocking:
+            handle = self._background_save(full, metrics)
+            _log("Save queued")
+            return handle
+        # A queued background checkpoint would only be overwritten by this one
+        if self.uploader is not None:
+            self.uploader.discard_queued()
+        profile = Profile("save", self.name)
+        saved = False
+        try:
+            saved = self._save_now(profile, full, metrics)
+        finally:
+            self._finish_profile(profile, saved)
+        _log("Save complete" if saved else "Save failed")
+        return saved
+
+    def maybe_checkpoint(self, step=None, blocking=True, metrics=None, fork=False):
+        # Saves if the scheduler says a checkpoint is due, and returns what
+        # save() returned, or None if it was not due. The time save() blocks
+        # for is the checkpoint cost the scheduler plans with.
+        if not self.scheduler.due(step):
+            return None
+        start = time.perf_counter()
+        saved = self.save(blocking=blocking, metrics=metrics, fork=fork)
+        cost = time.perf_counter() - start
+        upload_time = None
+        if fork or not blocking:
+            # The most recent background checkpoint that finished
+            for profile in reversed(self.recent_profiles):
+                if profile.operation == "save" and profile.ok:
+                    upload_time = profile.duration
+                    break
+        self.scheduler.record(cost, step, upload_time)
+        return saved
+
+    def emergency_save(self):
+        # The fastest checkpoint we can take once an interruption notice has
+        # arrived. Only watched parameters and small ones are serialized
+        # again, the rest staying as the last checkpoint stored them, and
+        # nothing is compressed. Queued checkpoints are dropped, and those
+        # already in flight get EMERGENCY_FLUSH_TIMEOUT seconds to finish
+        # before they are abandoned. With staging, the checkpoint is durable
+        # on local disk before anything is uploaded.
+        self._check_initialized()
+        _log("Initializing emergency save")
+        if self.uploader is not None:
+            self.uploader.discard_queued()
+        if not self.flush(EMERGENCY_FLUSH_TIMEOUT):
+            _log("Abandoning checkpoints in flight")
+        self._abandon_in_flight()
+        profile = Profile("emergency", self.name)
+        saved = False
+        try:
+            with profiling.activate(profile):
+                snapshot = self._snapshot(emergency=True)
+                if self.staging is not None:
+                    manifest = self._stage_state(snapshot)
+                    saved = self._safe_retry(
+                        lambda: self._drain(manifest, True), uploads=True
+                    )
+                else:
+                    manifest, objects = self._plan_state(snapshot, False, self.manifest)
+                    saved = self._safe_retry(
+                        lambda: self._sync(manifest, objects.__getitem__, True),
+                        uploads=True,
+                    )
+        finally:
+            # Checkpoints abandoned but still in flight are now older than
+            # this one, and are abandoned on that account instead
+            self._emergency = False
+            self._finish_profile(profile, saved)
+        _log("Emergency save complete" if saved else "Emergency save failed")
+        return saved
+
+    def compact(self, blocking=True):
+        # Folds every delta chain into a fresh base. The old bases and deltas
+        # are deleted once the new manifest is stored.
+        return self.save(blocking=blocking, full=True)
+
+    def checkpoints(self):
+        # The versions kept in S3, oldest first, each with the step it can be
+        # resumed from with setup(step=...)
+        return [
+            dict(step=sequence, **metadata)
+            for sequence, metadata in sorted(self.manifest.history.items())
+        ]
+
+    def collect_garbage(self):
+        # Checkpoints drop what they no longer need as they go. This sweeps up
+        # anything left behind, e.g. by checkpoints that failed halfway.
+        #
+        # In a distributed job, shards other ranks uploaded for a checkpoint
+        # the coordinator has not committed yet look unreferenced, so only
+        # the coordinator collects, and not while such a checkpoint is being
+        # gathered. Ranks still uploading before storing their manifest
+        # cannot be seen, so every rank should be done checkpointing first.
+        self._check_initialized()
+        if self.rank != COORDINATOR:
+            _log("Leaving garbage collection to the coordinator")
+            return True
+        self.flush()
+        if self.world_size > 1:
+            try:
+                pending = self._pending_checkpoints()
+            except TRANSFER_ERRORS as e:
+                _log("Failed to list rank manifests: {}".format(e))
+                return False
+            if pending:
+                _log(
+                    "Not collecting garbage while checkpoint {} is in progress".format(
+                        pending[0]
+                    )
+                )
+                return False
+        return self._safe_retry(self._collect_garbage)
+
+    def collect_chunks(self):
+        # Deletes chunks in the chunk store that no manifest in the bucket
+        # refers to. Chunks uploaded by a checkpoint another instance has not
+        # committed yet look unreferenced too, so this must not run while
+        # other instances sharing the bucket are checkpointing.
+        self._check_initialized()
+        self.flush()
+        return self._safe_retry(self._collect_chunks)
+
+    def profiles(self):
+        # Timings and byte counts of the most recent saves and restores,
+        # oldest first
+        return [profile.to_dict() for profile in self.recent_profiles]
+
+    def add_profile_hook(self, hook):
+        # hook is called with the Profile of every save and restore once it
+        # is done, from whichever thread finished it
+        self.profile_hooks.append(hook)
+
+    def remove_profile_hook(self, hook):
+        self.profile_hooks.remove(hook)
+
+    def prefetch(self, keys):
+        # Starts fetching lazily restored parameters in the background
+        for key in keys:
+            value = self.state["parameters"].get(key)
+            if isinstance(value, LazyValue):
+                if self._prefetcher is None:
+                    self._prefetcher = ThreadPoolExecutor(
+                        self.transfer_config.concurrency,
+                        thread_name_prefix="dalmatian-prefetch",
+                    )
+                value.prefetch(self._prefetcher)
+
+    def get_parameter(self, key, default=None):
+        if key not in self.state["parameters"]:
+            return default
+        return resolve(self.state["parameters"], key)
+
+    def parameters(self):
+        self._parameters_shared = True
+        return ParamsView(self.state["parameters"])
+
+    def update_parameters(self, d):
+        # Copy-on-write: the parameter dict is only copied if a ParamsView
+        # might still be looking at it, and then only its top level
+        if self._parameters_shared:
+            self.state["parameters"] = dict(self.state["parameters"])
+            self._parameters_shared = False
+        self.state["parameters"].update(d)
+
+    def remove_parameters(self, keys):
+        # Removed parameters are left out of the next checkpoint
+        if self._parameters_shared:
+            self.state["parameters"] = dict(self.state["parameters"])
+            self._parameters_shared = False
+        for key in keys:
+            self.state["parameters"].pop(key, None)
+
+    def metrics(self):
+        # Per-operation request counts, retries, throttles, failures and
+        # latency percentiles
+        return self.retrier.metrics.summary()
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._forked is not None and not self._forked.wait(timeout):
+            return False
+        if self.uploader is None:
+            return True
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        return self.uploader.flush(timeout)
+
+    def close(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._forked is not None:
+            self._forked.wait(timeout)
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=False)
+            self._prefetcher = None
+        if self.uploader is not None:
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            self.uploader.close(timeout)
+            self.uploader = None
 
     def erase(self):
+        # Let pending uploads land first so they cannot resurrect the state
+        self.close()
         self._safe_retry(self._erase_state)
 
 
@@ -123,6 +1464,31 @@ def _log(message):
     print(message)
 
 
+class _Superseded(Exception):
+    # Raised by a checkpoint in flight when a newer one, e.g. an emergency
+    # checkpoint, has taken over
+    pass
+
+
+class _UploadTimer:
+    # Passes writes through to a MultipartWriter, timing them as uploads so
+    # they are not counted as compression
+    def __init__(self, writer, profile):
+        self.writer = writer
+        self.profile = profile
+
+    def write(self, data):
+        with self.profile.phase("upload"):
+            return self.writer.write(data)
+
+    def close(self):
+        with self.profile.phase("upload"):
+            return self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
 def _preflight_checks(storage=True):
     assert instance != None, "No instance found, have you run dalmatian.setup() yet?"
     if storage:
@@ -134,17 +1500,30 @@ def _preflight_checks(storage=True):
 ### Public Interface ###
 
 
-def setup():
+def setup(**options):
+    # options are passed through to Instance, e.g. part_size and concurrency
+    # to tune transfers
     global instance
     instance_name = os.environ.get("DALMATIAN_INSTANCE") or DEFAULT_INSTANCE_NAME
+    if "DALMATIAN_STAGING_DIR" in os.environ:
+        options.setdefault("staging_dir", os.environ["DALMATIAN_STAGING_DIR"])
+    if "DALMATIAN_HAZARD_RATE" in os.environ:
+        options.setdefault("hazard_rate", float(os.environ["DALMATIAN_HAZARD_RATE"]))
+    if "DALMATIAN_PROFILE_LOG" in os.environ:
+        options.setdefault("profile_log", os.environ["DALMATIAN_PROFILE_LOG"])
+    watch = options.pop(
+        "watch_interruptions", bool(os.environ.get("DALMATIAN_WATCH_INTERRUPTIONS"))
+    )
     _log("Beginning setup")
-    instance = Instance(instance_name)
+    instance = Instance(instance_name, **options)
+    if watch:
+        watch_interruptions()
     _log("Setup complete")
 
 
 def store_params(d):
     _preflight_checks()
-    instance.state["parameters"].update(d)
+    instance.update_parameters(d)
     return get_params()
 
 
@@ -153,12 +1532,21 @@ def store_param(key, value):
 
 
 def get_params():
+    # Returns a read-only ParamsView rather than a copy. Use
+    # get_params().materialize() for a deep copy that can be modified.
     _preflight_checks()
-    return copy.deepcopy(instance.state["parameters"])
+    return instance.parameters()
 
 
 def get_param(key, default=None):
-    return instance.state["parameters"].get(key, default)
+    return instance.get_parameter(key, default)
+
+
+def prefetch(*keys):
+    # With setup(lazy=True), starts downloading the given parameters in the
+    # background ahead of their first access
+    _preflight_checks()
+    instance.prefetch(keys)
 
 
 class ImmutableObjectException(Exception):
@@ -181,16 +1569,67 @@ def watch_param(key, value):
         watch_set[key] = value
 
 
-def checkpoint():
+def checkpoint(blocking=True, metrics=None, fork=False):
+    # With blocking=False the state is snapshotted and uploaded in the
+    # background, and a CheckpointHandle is returned to wait on if needed.
+    # fork=True skips the in-memory snapshot: a forked process serializes
+    # and uploads the state instead, as it was at the fork.
+    _preflight_checks()
+    return instance.save(blocking=blocking, metrics=metrics, fork=fork)
+
+
+def maybe_checkpoint(step=None, blocking=True, metrics=None, fork=False):
+    # Cheap enough to call every batch: checkpoints only once the interval
+    # worked out from the interruption rate and checkpoint cost has passed
+    _preflight_checks()
+    return instance.maybe_checkpoint(
+        step, blocking=blocking, metrics=metrics, fork=fork
+    )
+
+
+def checkpoints():
+    _preflight_checks()
+    return instance.checkpoints()
+
+
+def collect_garbage():
+    _preflight_checks()
+    return instance.collect_garbage()
+
+
+def collect_chunks():
+    _preflight_checks()
+    return instance.collect_chunks()
+
+
+def profiles():
+    _preflight_checks(storage=False)
+    return instance.profiles()
+
+
+def add_profile_hook(hook):
+    _preflight_checks(storage=False)
+    instance.add_profile_hook(hook)
+
+
+def compact(blocking=True):
     _preflight_checks()
-    instance.save()
+    return instance.compact(blocking=blocking)
+
+
+def metrics():
+    _preflight_checks(storage=False)
+    return instance.metrics()
+
+
+def flush(timeout=None):
+    _preflight_checks(storage=False)
+    return instance.flush(timeout)
 
 
 def wipe():
-    # TODO This is a temporary way of handling the need to erase past training
-    # cycles. Ideally, there should be a way to use S3 versioning to do this
-    # instead. After that change, this should be a method of last-resort that
-    # wipes all data.
+    # A method of last resort that erases every version of the state. Past
+    # versions are otherwise dropped by the retention policy.
     global instance
     _preflight_checks(storage=False)
 
@@ -200,7 +1639,43 @@ def wipe():
     _log("Wipe complete")
 
 
-def terminate():
+def watch_interruptions(
+    on_interruption=_thread.interrupt_main,
+    endpoint=METADATA_ENDPOINT,
+    interval=DEFAULT_INTERVAL,
+):
+    # Watches for a spot interruption notice. When one arrives, an emergency
+    # checkpoint is taken, dalmatian shuts down, and on_interruption is
+    # called. By default that raises KeyboardInterrupt in the main thread so
+    # training unwinds cleanly.
+    global interruption_watcher
+    _preflight_checks(storage=False)
+
+    def on_notice(notice):
+        _log("Interruption notice received: {}".format(notice))
+        try:
+            if instance is not None and instance.storage_initialized:
+                instance.emergency_save()
+        finally:
+            # Checkpoints the emergency checkpoint abandoned stop at their
+            # next part, and are not waited on for long
+            terminate(EMERGENCY_CLOSE_TIMEOUT)
+            on_interruption()
+
+    if interruption_watcher is not None:
+        interruption_watcher.stop()
+    interruption_watcher = InterruptionWatcher(on_notice, endpoint, interval).start()
+    return interruption_watcher
+
+
+def terminate(timeout=None):
     # This is a stubbed method that could be used to do self-termination for
-    # AWS spot instances triggered without an orchestrator
-    pass
+    # AWS spot instances triggered without an orchestrator. Any background
+    # checkpoints are flushed first so they are not lost, waiting at most
+    # timeout seconds if given.
+    global interruption_watcher
+    if interruption_watcher is not None:
+        interruption_watcher.stop()
+        interruption_watcher = None
+    if instance is not None:
+        instance.close(timeout)
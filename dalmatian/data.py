@@ -0,0 +1,138 @@
+import random
+import sys
+
+# Mid-epoch resume. A checkpoint records how far into the epoch training got
+# and the state of the random number generators, and a resumed run carries
+# on from the next batch instead of starting the epoch over, e.g.
+#
+#   sampler = ResumableSampler(len(dataset), seed=1)
+#   loader = DataLoader(dataset, batch_size=64, sampler=sampler)
+#   restore(dalm.get_param("data"), sampler)
+#   for epoch in range(sampler.epoch, epochs):
+#       sampler.set_epoch(epoch)
+#       for batch in ResumableLoader(loader, sampler):
+#           train(batch)
+#           dalm.store_param("data", capture(sampler))
+#           dalm.maybe_checkpoint()
+#
+# Nothing is replayed: the sampler only hands out the indices that are left,
+# so skipped samples are never loaded.
+
+
+def capture_rng():
+    # The state of every random number generator in use. numpy and torch are
+    # only looked at if something has already imported them.
+    state = {"python": random.getstate()}
+    numpy = sys.modules.get("numpy")
+    if numpy is not None:
+        state["numpy"] = numpy.random.get_state()
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        state["torch"] = torch.get_rng_state()
+        if torch.cuda.is_available():
+            state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng(state):
+    random.setstate(state["python"])
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and "numpy" in state:
+        numpy.random.set_state(state["numpy"])
+    torch = sys.modules.get("torch")
+    if torch is not None and "torch" in state:
+        torch.set_rng_state(state["torch"])
+        # Generator states only carry over to the same number of GPUs
+        if (
+            torch.cuda.is_available()
+            and len(state.get("cuda", ())) == torch.cuda.device_count()
+        ):
+            torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class ResumableSampler:
+    # Hands out the indices of a dataset of the given length, shuffled the
+    # same way for a given seed and epoch, so its position within an epoch
+    # is all that needs to be stored. Works as a sampler for torch's
+    # DataLoader.
+
+    def __init__(self, length, shuffle=True, seed=0):
+        self.length = length
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        # Samples of this epoch already consumed by training
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        # Starts a new epoch, unless resuming the one the position is in
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+
+    def order(self):
+        indices = list(range(self.length))
+        if self.shuffle:
+            random.Random("{}-{}".format(self.seed, self.epoch)).shuffle(indices)
+        return indices
+
+    def __iter__(self):
+        return iter(self.order()[self.position :])
+
+    def __len__(self):
+        return self.length - self.position
+
+    def advance(self, count):
+        self.position = min(self.position + count, self.length)
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "position": self.position, "seed": self.seed}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.position = state["position"]
+        self.seed = state["seed"]
+
+
+class ResumableLoader:
+    # Iterates a data loader drawing from a ResumableSampler, and moves the
+    # sampler on as batches are handed to training. Loaders read ahead, so
+    # the sampler's own progress says nothing about what training has seen.
+    # A batch counts as consumed as soon as it is handed out, so checkpoint
+    # after it has been trained on.
+
+    def __init__(self, loader, sampler, batch_size=None):
+        self.loader = loader
+        self.sampler = sampler
+        self.batch_size = batch_size or loader.batch_size
+
+    def __iter__(self):
+        for batch in self.loader:
+            self.sampler.advance(self.batch_size)
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+
+def capture(sampler=None):
+    # A compact record of the position in the data and the random number
+    # generators, to store with a checkpoint
+    return {
+        "sampler": None if sampler is None else sampler.state_dict(),
+        "rng": capture_rng(),
+    }
+
+
+def restore(state, sampler=None):
+    # Puts back what capture() recorded. Does nothing if state is None, as
+    # on a fresh start.
+    if state is None:
+        return
+    restore_rng(state["rng"])
+    if sampler is not None and state["sampler"] is not None:
+        sampler.load_state_dict(state["sampler"])
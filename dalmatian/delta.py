@@ -0,0 +1,54 @@
+import pickle
+
+from .manifest import digest
+from .serialization import sliceable
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# A new base is written once a shard has this many deltas stacked on it
+DEFAULT_FULL_EVERY = 8
+# Deltas are only worth it while they are much smaller than the shard itself
+MAX_DELTA_RATIO = 0.5
+
+# Pickled arrays (numpy, torch) keep their data at the same offsets as long as
+# their shape and dtype do not change, so diffing the serialized bytes chunk
+# by chunk picks out the parts of the arrays that changed. Frozen layers hash
+# identically and are skipped.
+
+
+def chunk_digests(data, chunk_size=DEFAULT_CHUNK_SIZE):
+    view = sliceable(data)
+    return [digest(view[i : i + chunk_size]) for i in range(0, len(data), chunk_size)]
+
+
+def changed_chunks(previous, current):
+    return [
+        index
+        for index, chunk in enumerate(current)
+        if index >= len(previous) or previous[index] != chunk
+    ]
+
+
+def make_delta(data, indices, chunk_size=DEFAULT_CHUNK_SIZE):
+    view = sliceable(data)
+    return pickle.dumps(
+        {
+            "size": len(data),
+            "chunk_size": chunk_size,
+            "chunks": [
+                (index, bytes(view[index * chunk_size : (index + 1) * chunk_size]))
+                for index in indices
+            ],
+        }
+    )
+
+
+def apply_delta(bytedata, delta):
+    # bytedata is a bytearray which is patched in place
+    delta = pickle.loads(delta)
+    del bytedata[delta["size"] :]
+    bytedata.extend(bytes(delta["size"] - len(bytedata)))
+    chunk_size = delta["chunk_size"]
+    for index, chunk in delta["chunks"]:
+        offset = index * chunk_size
+        bytedata[offset : offset + len(chunk)] = chunk
+    return bytedata
@@ -0,0 +1,62 @@
+import hashlib
+import pickle
+import time
+
+from .manifest import Manifest
+
+# In a distributed job every rank checkpoints the parameters it owns, and
+# rank 0 coordinates. A checkpoint goes through two steps:
+#
+#   1. each rank uploads the shards it owns, then a manifest of just those
+#      under {state}/ranks/{sequence}/{rank}
+#   2. once every rank's manifest is there, the coordinator merges them and
+#      commits the result the same way a single process would, by writing the
+#      version and then the manifest pointer
+#
+# Until the pointer is written, restores keep seeing the previous checkpoint.
+# Ownership is worked out from the key and the current world size alone, so
+# when the world size changes, ranks simply own different keys. Every key
+# stays stored on its own, so any rank can read any of them.
+
+COORDINATOR = 0
+DEFAULT_TIMEOUT = 600
+POLL_INTERVAL = 1
+
+
+def owner_by_hash(key, world_size):
+    # Spreads keys evenly over ranks, the same way in every process
+    key_digest = hashlib.blake2b(pickle.dumps(key), digest_size=8).digest()
+    return int.from_bytes(key_digest, "big") % world_size
+
+
+def rank_manifest_name(state_name, sequence, rank=None):
+    prefix = "{}/ranks/{}/".format(state_name, sequence)
+    if rank is None:
+        return prefix
+    return prefix + str(rank)
+
+
+def merge(manifests, sequence, metadata):
+    # Combines the manifests of every rank into the manifest of the whole
+    # checkpoint. Two ranks owning the same key is a mistake in the owner
+    # function, and would silently lose one of them.
+    merged = Manifest(sequence=sequence, metadata=metadata)
+    for rank, manifest in sorted(manifests.items()):
+        for key, shard in manifest.shards.items():
+            if key in merged.shards:
+                raise ValueError("Key {!r} was stored by two ranks".format(key))
+            merged.shards[key] = shard
+    return merged
+
+
+def wait_for(condition, timeout=DEFAULT_TIMEOUT, interval=POLL_INTERVAL):
+    # Polls condition until it returns something other than None, or
+    # returns None once timeout seconds have passed
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result is not None:
+            return result
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(interval)
@@ -0,0 +1,77 @@
+import gc
+import os
+import pickle
+import signal
+
+# Runs a function in a forked child process. The child sees the parent's
+# memory as it was at the fork through copy-on-write pages, so the parent can
+# carry on changing it straight away, and only pages it changes meanwhile are
+# ever copied. The result comes back pickled over a pipe.
+
+
+def fork_call(function):
+    read_fd, write_fd = os.pipe()
+    # Frozen objects are left alone by the garbage collector, which would
+    # otherwise touch, and so copy, every page holding a tracked object
+    gc.freeze()
+    try:
+        pid = os.fork()
+    except BaseException:
+        gc.unfreeze()
+        raise
+    if pid == 0:
+        os.close(read_fd)
+        _run_child(function, write_fd)
+    gc.unfreeze()
+    os.close(write_fd)
+    return ForkedCall(pid, read_fd)
+
+
+def _run_child(function, write_fd):
+    # Never returns: the child must not carry on with the parent's work, or
+    # run its exit handlers
+    status = 1
+    try:
+        try:
+            result = (True, function())
+        except BaseException as e:
+            result = (False, e)
+        try:
+            data = pickle.dumps(result)
+        except Exception:
+            # e.g. an exception that cannot be pickled
+            data = pickle.dumps((False, RuntimeError(repr(result[1]))))
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(data)
+        status = 0
+    finally:
+        os._exit(status)
+
+
+class ForkedCall:
+    def __init__(self, pid, fd):
+        self.pid = pid
+        self.fd = fd
+
+    def kill(self):
+        # The child is not reaped here, so result() still reports how it
+        # ended
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def result(self):
+        # Waits for the child, then returns what the function returned or
+        # raises what it raised
+        with os.fdopen(self.fd, "rb") as f:
+            data = f.read()
+        _, status = os.waitpid(self.pid, 0)
+        if not data:
+            raise ChildProcessError(
+                "Process {} exited with status {}".format(self.pid, status)
+            )
+        ok, value = pickle.loads(data)
+        if not ok:
+            raise value
+        return value
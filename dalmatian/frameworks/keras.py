@@ -1,30 +1,174 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from tensorflow.keras import backend
 from tensorflow.keras.callbacks import Callback
 
+from ..uploader import FAILED
+
 DALMATIAN_NAMESPACE = "dalmatian-internal"
 EPOCH_KEY = "-".join((DALMATIAN_NAMESPACE, "keras-epoch"))
+BATCH_KEY = "-".join((DALMATIAN_NAMESPACE, "keras-batch"))
 MODEL_KEY = "-".join((DALMATIAN_NAMESPACE, "keras-model-weights"))
 OPTIMIZER_KEY = "-".join((DALMATIAN_NAMESPACE, "keras-optimizer-weights"))
 
 
 class Checkpoint(Callback):
-    def __init__(self, instance):
+    # Checkpoints at the end of every epoch, and optionally also every
+    # every_n_batches batches or every_seconds seconds within an epoch.
+    #
+    # Checkpoints within an epoch only copy the weights into buffers kept
+    # from one checkpoint to the next, and leave serializing and uploading
+    # them to a background thread. If that is still busy with the last one
+    # when another is due, the new one waits for the next batch rather than
+    # holding up training. Failed checkpoints are reported when the next one
+    # is taken, and at the end of training.
+
+    def __init__(self, instance, every_n_batches=None, every_seconds=None):
         self.instance = instance
+        self.every_n_batches = every_n_batches
+        self.every_seconds = every_seconds
+        self._buffers = {}
+        self._worker = None
+        self._pending = None
+        self._handles = []
+        self._epoch = 0
+        self._batches = 0
+        self._last_checkpoint = time.monotonic()
         super().__init__()
 
+    def _copy(self, key, variables):
+        # Reads every variable in one call, which is one session run outside
+        # of eager execution, and copies the values into the buffers kept for
+        # key. The buffers are what the background thread serializes, so the
+        # values read for the next checkpoint can be dropped straight away.
+        values = backend.batch_get_value(list(variables))
+        layout = [(value.shape, value.dtype) for value in values]
+        buffers = self._buffers.get(key)
+        if buffers is None or [(b.shape, b.dtype) for b in buffers] != layout:
+            buffers = self._buffers[key] = [
+                numpy.empty(shape, dtype) for shape, dtype in layout
+            ]
+        for buffer, value in zip(buffers, values):
+            numpy.copyto(buffer, value)
+        return buffers
+
+    def _snapshot(self):
+        # In the same order as get_weights(), so load_weights() can hand them
+        # to set_weights()
+        return {
+            MODEL_KEY: self._copy(MODEL_KEY, self.model.weights),
+            OPTIMIZER_KEY: self._copy(
+                OPTIMIZER_KEY, _optimizer_variables(self.model.optimizer)
+            ),
+        }
+
+    def _due(self):
+        if self.every_n_batches and self._batches >= self.every_n_batches:
+            return True
+        return bool(
+            self.every_seconds
+            and time.monotonic() - self._last_checkpoint >= self.every_seconds
+        )
+
+    def _store(self, parameters, blocking):
+        self.instance.update_parameters(parameters)
+        return self.instance.save(blocking=blocking)
+
+    def _finish_pending(self):
+        # Waits for the background thread to hand the last checkpoint over,
+        # which raises anything that went wrong serializing it
+        if self._pending is not None:
+            self._handles.append(self._pending.result())
+            self._pending = None
+
+    def _check_uploaded(self):
+        # Reports background checkpoints whose upload failed
+        for handle in [handle for handle in self._handles if handle.done()]:
+            self._handles.remove(handle)
+            if handle.status == FAILED:
+                print("Background checkpoint failed: {}".format(handle.error))
+
+    def on_train_begin(self, logs=None):
+        # Started per call to fit(), and shut down again at its end
+        self._worker = ThreadPoolExecutor(1, thread_name_prefix="dalmatian-keras")
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._batches += 1
+        if not self._due():
+            return
+        if self._pending is not None and not self._pending.done():
+            return
+        self._finish_pending()
+        self._check_uploaded()
+        parameters = self._snapshot()
+        # Resuming from here restarts the epoch in progress, which is only
+        # complete up to the previous one
+        parameters[EPOCH_KEY] = self._epoch - 1
+        parameters[BATCH_KEY] = batch
+        self._pending = self._worker.submit(self._store, parameters, False)
+        self._batches = 0
+        self._last_checkpoint = time.monotonic()
+
     def on_epoch_end(self, epoch, logs=None):
-        state_parameters = self.instance.state["parameters"]
-        state_parameters[EPOCH_KEY] = epoch
-        state_parameters[MODEL_KEY] = self.model.get_weights()
-        state_parameters[OPTIMIZER_KEY] = self.model.optimizer.get_weights()
-        self.instance.save()
+        # Buffers are only reused once the background thread is done with
+        # them
+        self._finish_pending()
+        self._check_uploaded()
+        parameters = self._snapshot()
+        parameters[EPOCH_KEY] = epoch
+        parameters[BATCH_KEY] = None
+        if not self._store(parameters, True):
+            print("Checkpoint at the end of epoch {} failed".format(epoch))
+        self._batches = 0
+        self._last_checkpoint = time.monotonic()
+
+    def on_train_end(self, logs=None):
+        try:
+            self._finish_pending()
+        finally:
+            self._worker.shutdown()
+        self.instance.flush()
+        self._check_uploaded()
+
+
+def _optimizer_variables(optimizer):
+    # A method on TF2 optimizers before Keras 2.11 and a property after. The
+    # TF1 optimizers only have weights.
+    variables = getattr(optimizer, "variables", None)
+    if variables is None:
+        return optimizer.weights
+    return variables() if callable(variables) else variables
+
+
+def _build_optimizer(model):
+    # Optimizers only create their variables on the first training step
+    optimizer = model.optimizer
+    if hasattr(model, "_make_train_function"):
+        model._make_train_function()  # TF1
+    elif hasattr(optimizer, "_create_all_weights"):
+        optimizer._create_all_weights(model.trainable_variables)  # TF2
+    else:
+        optimizer.build(model.trainable_variables)  # Keras 2.11 onwards
 
 
 def load_weights(stored_state, model):
     if MODEL_KEY in stored_state and model:
         model.set_weights(stored_state[MODEL_KEY])
         if OPTIMIZER_KEY in stored_state and model.optimizer:
-            model._make_train_function()  # needed to initialize the optimizer
-            model.optimizer.set_weights(stored_state[OPTIMIZER_KEY])
+            _build_optimizer(model)
+            variables = list(_optimizer_variables(model.optimizer))
+            values = stored_state[OPTIMIZER_KEY]
+            if len(variables) != len(values):
+                raise ValueError(
+                    "Stored optimizer state has {} weights, but the optimizer"
+                    " has {}".format(len(values), len(variables))
+                )
+            backend.batch_set_value(list(zip(variables, values)))
 
 
 def load_initial_epoch(stored_state):
@@ -0,0 +1,123 @@
+import torch
+
+from ..data import capture, restore
+
+DALMATIAN_NAMESPACE = "dalmatian-internal"
+MODEL_KEY = "-".join((DALMATIAN_NAMESPACE, "pytorch-model"))
+OPTIMIZER_KEY = "-".join((DALMATIAN_NAMESPACE, "pytorch-optimizer"))
+SCHEDULER_KEY = "-".join((DALMATIAN_NAMESPACE, "pytorch-scheduler"))
+DATA_KEY = "-".join((DALMATIAN_NAMESPACE, "pytorch-data"))
+EXTRA_KEY = "-".join((DALMATIAN_NAMESPACE, "pytorch-extra"))
+
+
+class Checkpoint:
+    # Checkpoints a model along with its optimizer, learning rate scheduler,
+    # the random number generators and, given a ResumableSampler, the
+    # position within the epoch, e.g.
+    #
+    #   checkpoint = Checkpoint(dalm.instance, model, optimizer, scheduler)
+    #   start_epoch = (checkpoint.restore() or {}).get("epoch", 0)
+    #   ...
+    #   checkpoint.save(epoch=epoch)
+    #
+    # GPU tensors are copied into pinned CPU buffers on a side stream, so
+    # training kernels already queued keep running while they copy. The
+    # buffers are allocated once and reused by every checkpoint. CPU tensors
+    # are serialized as they are. Either way their data is stored as raw
+    # out-of-band buffers rather than pickled.
+
+    def __init__(self, instance, model, optimizer=None, scheduler=None, sampler=None):
+        self.instance = instance
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.sampler = sampler
+        self._buffers = {}
+        self._stream = None
+        if torch.cuda.is_available():
+            self._stream = torch.cuda.Stream()
+
+    def _offload(self, obj, path=()):
+        # Returns obj with every GPU tensor replaced by a pinned CPU copy.
+        # The copies are only queued; wait on the stream before reading them.
+        if isinstance(obj, torch.Tensor):
+            if not obj.is_cuda:
+                return obj.detach()
+            buffer = self._buffers.get(path)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(
+                    obj.shape, dtype=obj.dtype, device="cpu", pin_memory=True
+                )
+                self._buffers[path] = buffer
+            # The side stream must not read the tensor before the kernels
+            # writing it have run
+            self._stream.wait_stream(torch.cuda.current_stream(obj.device))
+            with torch.cuda.stream(self._stream):
+                buffer.copy_(obj.detach(), non_blocking=True)
+            obj.record_stream(self._stream)
+            return buffer
+        if isinstance(obj, dict):
+            return {
+                key: self._offload(value, path + (key,)) for key, value in obj.items()
+            }
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(
+                self._offload(value, path + (i,)) for i, value in enumerate(obj)
+            )
+        return obj
+
+    def state(self, **extra):
+        # The checkpointed state, on the CPU and ready to serialize
+        state = {
+            MODEL_KEY: self._offload(self.model.state_dict(), (MODEL_KEY,)),
+            DATA_KEY: capture(self.sampler),
+            EXTRA_KEY: extra,
+        }
+        if self.optimizer is not None:
+            state[OPTIMIZER_KEY] = self._offload(
+                self.optimizer.state_dict(), (OPTIMIZER_KEY,)
+            )
+        if self.scheduler is not None:
+            state[SCHEDULER_KEY] = self.scheduler.state_dict()
+        if self._stream is not None:
+            self._stream.synchronize()
+        return state
+
+    def save(self, blocking=True, metrics=None, fork=False, **extra):
+        # extra values, e.g. epoch=3, are handed back by restore()
+        self.instance.update_parameters(self.state(**extra))
+        return self.instance.save(blocking=blocking, metrics=metrics, fork=fork)
+
+    def restore(self, map_location=None, strict=True):
+        # Loads the last checkpoint into the model, optimizer and scheduler,
+        # and returns the extra values it was saved with, or None if there
+        # is nothing to restore. Model weights are copied straight into the
+        # existing parameters. map_location moves the stored tensors first,
+        # like it does for torch.load.
+        get = self.instance.get_parameter
+        model_state = get(MODEL_KEY)
+        if model_state is None:
+            return None
+
+        def load(state):
+            if map_location is None:
+                return state
+            return _map_tensors(state, lambda tensor: tensor.to(map_location))
+
+        self.model.load_state_dict(load(model_state), strict=strict)
+        if self.optimizer is not None and get(OPTIMIZER_KEY) is not None:
+            self.optimizer.load_state_dict(load(get(OPTIMIZER_KEY)))
+        if self.scheduler is not None and get(SCHEDULER_KEY) is not None:
+            self.scheduler.load_state_dict(get(SCHEDULER_KEY))
+        restore(get(DATA_KEY), self.sampler)
+        return dict(get(EXTRA_KEY) or {})
+
+
+def _map_tensors(obj, function):
+    if isinstance(obj, torch.Tensor):
+        return function(obj)
+    if isinstance(obj, dict):
+        return {key: _map_tensors(value, function) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(value, function) for value in obj)
+    return obj
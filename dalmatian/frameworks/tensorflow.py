@@ -1,26 +1,100 @@
-from tensorflow.train import Saver
-from tensorflow.python.framework.errors_impl import NotFoundError
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+
+DALMATIAN_NAMESPACE = "dalmatian-internal"
+# The names of the files making up the stored checkpoint. Each file is a
+# parameter of its own under FILE_KEY_PREFIX, so they are uploaded in
+# parallel and unchanged ones are not uploaded again.
+FILES_KEY = "-".join((DALMATIAN_NAMESPACE, "tensorflow-files"))
+FILE_KEY_PREFIX = "-".join((DALMATIAN_NAMESPACE, "tensorflow-file")) + "/"
+CHECKPOINT_NAME = "model.ckpt"
 
 
 class Checkpoint:
-    def __init__(self, instance):
+    # Saves TensorFlow variables through dalmatian. tf.train.Checkpoint
+    # writes its index and data files to local disk, and they are then stored
+    # along with the rest of the state, e.g.
+    #
+    #   checkpoint = Checkpoint(dalm.instance, model=model, optimizer=optimizer)
+    #   checkpoint.restore()
+    #   ...
+    #   checkpoint.save()
+    #
+    # Without any objects to track, every global variable is saved, which
+    # suits graph mode code run in a session.
+    #
+    # Files are written to a temporary directory of their own, made inside
+    # directory if one is given, and removed by close().
+
+    def __init__(self, instance, directory=None, **objects):
         self.instance = instance
-        self.saver = Saver()
-        self.s3_path = "s3://{}/{}-state-tensorflow/model.ckpt".format(
-            instance.bucket.name, instance.name
-        )
+        if not objects:
+            objects = {
+                variable.op.name.replace("/", "."): variable
+                for variable in tf.compat.v1.global_variables()
+            }
+        if tf.executing_eagerly():
+            self.checkpoint = tf.train.Checkpoint(**objects)
+        else:
+            self.checkpoint = tf.compat.v1.train.Checkpoint(**objects)
+        self.directory = tempfile.mkdtemp(prefix="dalmatian-tf-", dir=directory)
+        self.prefix = os.path.join(self.directory, CHECKPOINT_NAME)
 
-    def save(self, sess):
-        self.saver.save(sess, self.s3_path)
-
-    def restore(self, sess):
-        # This is obviously a hacky way of making restore a no-op when we have nothing
-        # to restore, but I am not certain right now of a better way of doing this
-        try:
-            self.saver.restore(sess, self.s3_path)
-        except NotFoundError as e:
-            if "Failed to find any matching files" in e.message:
-                # There was nothing to restore
-                return
+    def _clear(self):
+        # Only ever holds files written here, e.g. a temporary directory TF
+        # left behind on a failed write
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
             else:
-                raise e
+                os.remove(path)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save(self, session=None, blocking=True, metrics=None):
+        self._clear()
+        if session is None:
+            self.checkpoint.write(self.prefix)
+        else:
+            self.checkpoint.write(self.prefix, session=session)
+        files = {}
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name), "rb") as f:
+                files[name] = f.read()
+
+        stored = self.instance.get_parameter(FILES_KEY) or ()
+        self.instance.remove_parameters(
+            FILE_KEY_PREFIX + name for name in stored if name not in files
+        )
+        self.instance.update_parameters(
+            {FILE_KEY_PREFIX + name: data for name, data in files.items()}
+        )
+        self.instance.update_parameters({FILES_KEY: sorted(files)})
+        return self.instance.save(blocking=blocking, metrics=metrics)
+
+    def restore(self, session=None):
+        # Returns False if there is nothing to restore
+        names = self.instance.get_parameter(FILES_KEY)
+        if not names:
+            return False
+        self._clear()
+        for name in names:
+            with open(os.path.join(self.directory, name), "wb") as f:
+                f.write(self.instance.get_parameter(FILE_KEY_PREFIX + name))
+        status = self.checkpoint.restore(self.prefix)
+        if session is None:
+            status.assert_existing_objects_matched()
+        else:
+            status.initialize_or_restore(session)
+        return True
@@ -0,0 +1,92 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+# EC2 posts a notice to the instance metadata service two minutes before a
+# spot instance is stopped or terminated. Until then the instance-action path
+# returns a 404.
+#
+# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/spot-instance-termination-notices.html
+
+METADATA_ENDPOINT = "http://169.254.169.254"
+TOKEN_PATH = "/latest/api/token"
+INSTANCE_ACTION_PATH = "/latest/meta-data/spot/instance-action"
+TOKEN_TTL = 21600
+DEFAULT_INTERVAL = 5
+DEFAULT_TIMEOUT = 2
+
+
+def fetch_notice(endpoint=METADATA_ENDPOINT, timeout=DEFAULT_TIMEOUT):
+    # Returns the interruption notice, e.g. {"action": "stop", "time": ...},
+    # or None if there is none
+    headers = {}
+    token = _fetch_token(endpoint, timeout)
+    if token is not None:
+        headers["X-aws-ec2-metadata-token"] = token
+    request = urllib.request.Request(endpoint + INSTANCE_ACTION_PATH, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode())
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise e
+
+
+def _fetch_token(endpoint, timeout):
+    # IMDSv2 requires a session token. Endpoints that only speak IMDSv1 are
+    # queried without one.
+    request = urllib.request.Request(
+        endpoint + TOKEN_PATH,
+        method="PUT",
+        headers={"X-aws-ec2-metadata-token-ttl-seconds": str(TOKEN_TTL)},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read().decode()
+    except OSError:
+        return None
+
+
+class InterruptionWatcher:
+    # Polls for an interruption notice in a daemon thread and calls
+    # on_notice(notice) once when one shows up
+
+    def __init__(
+        self,
+        on_notice,
+        endpoint=METADATA_ENDPOINT,
+        interval=DEFAULT_INTERVAL,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        self.on_notice = on_notice
+        self.endpoint = endpoint
+        self.interval = interval
+        self.timeout = timeout
+        self.notice = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name="dalmatian-interruption-watcher", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                notice = fetch_notice(self.endpoint, self.timeout)
+            except (OSError, ValueError):
+                # The metadata service being briefly unreachable is not a
+                # reason to stop watching
+                notice = None
+            if notice is not None:
+                self.notice = notice
+                self.on_notice(notice)
+                return
+            self._stopped.wait(self.interval)
@@ -0,0 +1,149 @@
+import hashlib
+import pickle
+
+from .serialization import buffers_of
+
+MANIFEST_VERSION = 2
+# Encoded manifests start with this, followed by the digest of the rest, so
+# a torn or corrupted manifest is caught before anything is unpickled
+MAGIC = b"DLMM"
+DIGEST_SIZE = 20
+
+
+class CorruptionError(Exception):
+    # Stored data is missing or does not match its checksum. Unlike transfer
+    # errors, retrying will not help.
+    pass
+
+
+def digest(data):
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for buffer in buffers_of(data):
+        hasher.update(buffer)
+    return hasher.hexdigest()
+
+
+class Shard:
+    # A shard is either stored in full under its own digest, or as a base
+    # object plus a chain of deltas which are replayed on top of it. `chunks`
+    # holds the digests of the fixed-size chunks of the current contents, so
+    # the next checkpoint can work out which chunks changed without fetching
+    # anything back.
+    #
+    # Shards in the bucket-wide chunk store instead list the (digest, length)
+    # of the chunks making them up in `parts`, and have no objects of their
+    # own.
+
+    def __init__(
+        self,
+        digest,
+        size,
+        base=None,
+        base_size=None,
+        deltas=(),
+        chunks=None,
+        parts=None,
+    ):
+        self.digest = digest
+        self.size = size
+        self.base = base or digest
+        self.base_size = size if base_size is None else base_size
+        self.deltas = tuple(deltas)
+        self.chunks = chunks
+        self.parts = parts
+
+    def objects(self):
+        if self.parts is not None:
+            return ()
+        return (self.base,) + self.deltas
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Shard)
+            and self.digest == other.digest
+            and self.size == other.size
+            and self.objects() == other.objects()
+            and self.parts == other.parts
+        )
+
+    def __repr__(self):
+        return "Shard({}, {}, deltas={})".format(
+            self.digest, self.size, len(self.deltas)
+        )
+
+
+class Manifest:
+    # The manifest maps every top-level parameter key to the shard holding its
+    # pickled value. Stored objects are named by the digest of their contents,
+    # so an unchanged parameter keeps pointing at the same objects between
+    # checkpoints and never needs to be uploaded again. The sequence number
+    # goes up with every checkpoint and identifies its version.
+    #
+    # metadata records when the checkpoint was taken and any metrics given
+    # with it. history maps the sequence number of every version still kept
+    # around, this one included, to its metadata.
+
+    def __init__(self, shards=None, sequence=0, metadata=None, history=None):
+        self.shards = shards or {}
+        self.sequence = sequence
+        self.metadata = metadata or {}
+        self.history = history or {}
+
+    def digests(self):
+        return {
+            digest for shard in self.shards.values() for digest in shard.objects()
+        }
+
+    def parts(self):
+        return {
+            part_digest
+            for shard in self.shards.values()
+            for part_digest, _ in shard.parts or ()
+        }
+
+    def encode(self):
+        # Pickled rather than JSON since parameter keys need not be strings
+        payload = pickle.dumps(
+            {
+                "version": MANIFEST_VERSION,
+                "sequence": self.sequence,
+                "metadata": self.metadata,
+                "history": self.history,
+                "shards": {
+                    key: {
+                        "digest": shard.digest,
+                        "size": shard.size,
+                        "base": shard.base,
+                        "base_size": shard.base_size,
+                        "deltas": shard.deltas,
+                        "chunks": shard.chunks,
+                        "parts": shard.parts,
+                    }
+                    for key, shard in self.shards.items()
+                },
+            }
+        )
+        return MAGIC + bytes.fromhex(digest(payload)) + payload
+
+    @classmethod
+    def decode(cls, data):
+        # Manifests stored before checksums were added are still read
+        data = bytes(data)
+        if data.startswith(MAGIC):
+            checksum = data[len(MAGIC) : len(MAGIC) + DIGEST_SIZE]
+            data = data[len(MAGIC) + DIGEST_SIZE :]
+            if checksum != bytes.fromhex(digest(data)):
+                raise CorruptionError("Manifest failed verification")
+        try:
+            raw = pickle.loads(data)
+        except Exception as e:
+            raise CorruptionError("Manifest could not be read: {}".format(e))
+        if raw["version"] == 1:
+            return cls({key: Shard(*shard) for key, shard in raw["shards"].items()})
+        assert raw["version"] == MANIFEST_VERSION, "Unknown manifest version"
+        return cls(
+            {key: Shard(**shard) for key, shard in raw["shards"].items()},
+            raw.get("sequence", 0),
+            raw.get("metadata"),
+            raw.get("history"),
+        )
@@ -0,0 +1,73 @@
+import copy
+import threading
+from collections.abc import Mapping
+
+
+class LazyValue:
+    # Stands in for a parameter that has not been downloaded yet. The value
+    # is fetched on first access, or in the background by prefetch(), and
+    # shared by everything holding this placeholder. A parameter that was
+    # never loaded cannot have changed, so checkpoints keep its shard as is.
+
+    def __init__(self, shard, fetch):
+        self.shard = shard
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self._future = None
+        self._value = None
+        self.loaded = False
+
+    def prefetch(self, executor):
+        with self._lock:
+            if not self.loaded and self._future is None:
+                self._future = executor.submit(self._fetch, self.shard)
+
+    def get(self):
+        with self._lock:
+            if not self.loaded:
+                if self._future is not None:
+                    self._value = self._future.result()
+                else:
+                    self._value = self._fetch(self.shard)
+                self.loaded = True
+                self._future = None
+        return self._value
+
+
+def resolve(parameters, key):
+    # Returns the value for key, loading it first if it is a LazyValue
+    value = parameters[key]
+    if isinstance(value, LazyValue):
+        value = value.get()
+        parameters[key] = value
+    return value
+
+
+class ParamsView(Mapping):
+    # A read-only view of the stored parameters, handed out by get_params()
+    # instead of a deep copy. The instance copies its (top-level) parameter
+    # dict before changing it while views are around, so a view keeps showing
+    # the parameters as they were when it was taken. Values themselves are
+    # shared, not copied: call materialize() for a fully independent copy.
+
+    def __init__(self, parameters):
+        self._parameters = parameters
+
+    def __getitem__(self, key):
+        return resolve(self._parameters, key)
+
+    def __iter__(self):
+        return iter(self._parameters)
+
+    def __len__(self):
+        return len(self._parameters)
+
+    def __contains__(self, key):
+        # Checking for a key should not download its value
+        return key in self._parameters
+
+    def __repr__(self):
+        return "ParamsView({!r})".format(self._parameters)
+
+    def materialize(self):
+        return copy.deepcopy({key: self[key] for key in self._parameters})
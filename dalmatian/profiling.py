@@ -0,0 +1,284 @@
+import collections
+import contextlib
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Every save and restore is recorded in a Profile: how long was spent in each
+# phase (serialize, plan, compress, upload, download, verify, ...) and how
+# many bytes went where. The profile of the operation in progress is kept per
+# thread, so code deep inside a save can add to it without passing it around,
+# and work handed to thread pools carries it along through bind().
+#
+# Phase times are summed over every thread that worked on the operation, so
+# with parallel uploads they can add up to more than its duration.
+
+DEFAULT_STATSD_ADDRESS = "localhost:8125"
+DEFAULT_PROMETHEUS_PORT = 9109
+
+_active = threading.local()
+
+
+class Profile:
+    def __init__(self, operation, instance_name):
+        self.operation = operation
+        self.instance = instance_name
+        self.time = time.time()
+        self.duration = None
+        self.ok = None
+        self.sequence = None
+        self.phases = collections.Counter()
+        self.bytes = collections.Counter()
+        self.counts = collections.Counter()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._frames = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Phases nest, and time spent in an inner phase only counts towards
+        # that one, e.g. uploading while compressing
+        stack = getattr(self._frames, "stack", None)
+        if stack is None:
+            stack = self._frames.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.phases[name] += elapsed - inner
+
+    def __getstate__(self):
+        # Profiles are sent back from forked checkpoints, without their locks
+        state = dict(self.__dict__)
+        del state["_lock"], state["_frames"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._frames = threading.local()
+
+    def add_bytes(self, name, count):
+        with self._lock:
+            self.bytes[name] += count
+
+    def add_count(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+
+    def finish(self, ok):
+        self.duration = time.perf_counter() - self._start
+        self.ok = bool(ok)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "operation": self.operation,
+                "instance": self.instance,
+                "time": self.time,
+                "duration": self.duration,
+                "ok": self.ok,
+                "sequence": self.sequence,
+                "phases": dict(self.phases),
+                "bytes": dict(self.bytes),
+                "counts": dict(self.counts),
+            }
+
+
+class _NullProfile:
+    # Stands in when no operation is being profiled
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def add_bytes(self, name, count):
+        pass
+
+    def add_count(self, name, count=1):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+def current():
+    return getattr(_active, "profile", None) or NULL_PROFILE
+
+
+@contextlib.contextmanager
+def activate(profile):
+    previous = getattr(_active, "profile", None)
+    _active.profile = profile
+    try:
+        yield profile
+    finally:
+        _active.profile = previous
+
+
+def bind(function):
+    # Wraps function to run under the calling thread's profile, wherever it
+    # is called from
+    profile = current()
+
+    def bound(*args, **kwargs):
+        with activate(profile):
+            return function(*args, **kwargs)
+
+    return bound
+
+
+class JsonlLog:
+    # A hook appending every profile to a file, one JSON object per line
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, profile):
+        line = json.dumps(profile.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class StatsdClient:
+    # A hook sending timings (in milliseconds) and byte counts to a StatsD
+    # server over UDP, e.g. dalmatian.save.upload:12.5|ms
+    def __init__(self, address=DEFAULT_STATSD_ADDRESS, prefix="dalmatian"):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "localhost", int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, profile):
+        name = "{}.{}".format(self.prefix, profile.operation)
+        lines = ["{}.duration:{:.3f}|ms".format(name, profile.duration * 1000)]
+        lines.append("{}.{}:1|c".format(name, "ok" if profile.ok else "failed"))
+        for phase, seconds in profile.phases.items():
+            lines.append("{}.{}:{:.3f}|ms".format(name, phase, seconds * 1000))
+        for kind, count in profile.bytes.items():
+            lines.append("{}.bytes.{}:{}|c".format(name, kind, count))
+        try:
+            self._socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError:
+            pass  # metrics are best effort
+
+
+class PrometheusExporter:
+    # A hook totalling profiles into counters that are served in the
+    # Prometheus text format at http://{host}:{port}/metrics
+    def __init__(self, port=DEFAULT_PROMETHEUS_PORT, host="127.0.0.1"):
+        self._lock = threading.Lock()
+        self._operations = collections.Counter()
+        self._seconds = collections.Counter()
+        self._phases = collections.Counter()
+        self._bytes = collections.Counter()
+        self._last_duration = {}
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.server.serve_forever,
+            name="dalmatian-prometheus",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def __call__(self, profile):
+        operation = profile.operation
+        with self._lock:
+            self._operations[operation, "ok" if profile.ok else "failed"] += 1
+            self._seconds[operation,] += profile.duration
+            self._last_duration[operation,] = profile.duration
+            for phase, seconds in profile.phases.items():
+                self._phases[operation, phase] += seconds
+            for kind, count in profile.bytes.items():
+                self._bytes[operation, kind] += count
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, kind, labels, samples in (
+                (
+                    "dalmatian_operations_total",
+                    "counter",
+                    ("operation", "outcome"),
+                    self._operations,
+                ),
+                (
+                    "dalmatian_operation_seconds_total",
+                    "counter",
+                    ("operation",),
+                    self._seconds,
+                ),
+                (
+                    "dalmatian_last_operation_seconds",
+                    "gauge",
+                    ("operation",),
+                    self._last_duration,
+                ),
+                (
+                    "dalmatian_phase_seconds_total",
+                    "counter",
+                    ("operation", "phase"),
+                    self._phases,
+                ),
+                (
+                    "dalmatian_bytes_total",
+                    "counter",
+                    ("operation", "kind"),
+                    self._bytes,
+                ),
+            ):
+                lines.append("# TYPE {} {}".format(name, kind))
+                for values, value in sorted(samples.items()):
+                    lines.append(
+                        "{}{{{}}} {}".format(
+                            name,
+                            ",".join(
+                                '{}="{}"'.format(label, label_value)
+                                for label, label_value in zip(labels, values)
+                            ),
+                            value,
+                        )
+                    )
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def prometheus_exporter(port=DEFAULT_PROMETHEUS_PORT, host="127.0.0.1"):
+    # One exporter per port for the whole process, since setup() can be
+    # called more than once
+    with _exporters_lock:
+        if (host, port) not in _exporters:
+            _exporters[host, port] = PrometheusExporter(port, host)
+        return _exporters[host, port]
@@ -0,0 +1,34 @@
+class RetentionPolicy:
+    # Decides which checkpoint versions to keep. A version is kept if any
+    # rule asks for it, and the latest version is always kept.
+    #
+    #   keep_last: the most recent N versions
+    #   keep_every: every version whose sequence number is a multiple of K
+    #   keep_best: the N versions with the best value of a metric, given as
+    #       (metric name, "min" or "max", N)
+
+    def __init__(self, keep_last=1, keep_every=None, keep_best=None):
+        assert keep_last >= 1, "keep_last must be at least 1"
+        if keep_best is not None:
+            metric, mode, count = keep_best
+            assert mode in ("min", "max"), "keep_best mode must be min or max"
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+
+    def retain(self, history):
+        # history maps sequence numbers to each version's metadata
+        sequences = sorted(history)
+        keep = set(sequences[-self.keep_last :])
+        if self.keep_every:
+            keep.update(s for s in sequences if s % self.keep_every == 0)
+        if self.keep_best is not None:
+            metric, mode, count = self.keep_best
+            scored = [
+                (history[s]["metrics"][metric], s)
+                for s in sequences
+                if metric in history[s].get("metrics", {})
+            ]
+            scored.sort(reverse=(mode == "max"))
+            keep.update(s for _, s in scored[:count])
+        return keep
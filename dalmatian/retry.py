@@ -0,0 +1,156 @@
+import collections
+import random
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# Error codes S3 uses to ask clients to slow down
+THROTTLING_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "503",
+}
+TRANSIENT_CODES = {
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "InternalError",
+    "500",
+    "502",
+    "504",
+}
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_BASE_DELAY = 0.25
+DEFAULT_MAX_DELAY = 20
+# Latency samples kept per operation for percentiles
+LATENCY_SAMPLES = 1000
+
+
+class RetryError(IOError):
+    def __init__(self, error, attempts):
+        self.error = error
+        self.attempts = attempts
+        super().__init__("Giving up after {} attempts: {}".format(attempts, error))
+
+
+def classify(error):
+    if isinstance(error, ClientError):
+        code = str(error.response.get("Error", {}).get("Code", ""))
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if code in THROTTLING_CODES or status == 503:
+            return THROTTLED
+        if code in TRANSIENT_CODES or (status is not None and status >= 500):
+            return TRANSIENT
+        return FATAL
+    status = getattr(error, "status", None)
+    if status is not None:
+        if status == 503:
+            return THROTTLED
+        return TRANSIENT if status >= 500 else FATAL
+    # Connection resets, timeouts and the like
+    if isinstance(error, (BotoCoreError, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return FATAL
+
+
+class RetryMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.retries = collections.Counter()
+        self.throttles = collections.Counter()
+        self.failures = collections.Counter()
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=LATENCY_SAMPLES)
+        )
+
+    def record(self, operation, latency, outcome):
+        with self._lock:
+            self.calls[operation] += 1
+            self._latencies[operation].append(latency)
+            if outcome == THROTTLED:
+                self.throttles[operation] += 1
+            if outcome in (THROTTLED, TRANSIENT):
+                self.retries[operation] += 1
+            elif outcome == FATAL:
+                self.failures[operation] += 1
+
+    def summary(self):
+        with self._lock:
+            summary = {}
+            for operation, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                summary[operation] = {
+                    "calls": self.calls[operation],
+                    "retries": self.retries[operation],
+                    "throttles": self.throttles[operation],
+                    "failures": self.failures[operation],
+                    "latency_p50": _percentile(ordered, 0.5),
+                    "latency_p99": _percentile(ordered, 0.99),
+                    "latency_max": ordered[-1],
+                }
+            return summary
+
+
+class Retrier:
+    # Retries individual requests with exponential backoff and full jitter.
+    # Throttling also raises a shared backoff level, so that every thread
+    # slows down together when S3 asks it to, and the level decays again as
+    # requests succeed.
+
+    def __init__(
+        self,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        base_delay=DEFAULT_BASE_DELAY,
+        max_delay=DEFAULT_MAX_DELAY,
+        metrics=None,
+        sleep=time.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics or RetryMetrics()
+        self.sleep = sleep
+        self._throttle_level = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        with self._lock:
+            exponent = attempt + self._throttle_level
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** exponent))
+
+    def call(self, operation, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                self.metrics.record(operation, time.monotonic() - start, kind)
+                attempt += 1
+                if kind == FATAL:
+                    raise e
+                if attempt >= self.max_attempts:
+                    raise RetryError(e, attempt) from e
+                if kind == THROTTLED:
+                    with self._lock:
+                        self._throttle_level = min(self._throttle_level + 1, 8)
+                self.sleep(self.delay(attempt))
+                continue
+            self.metrics.record(operation, time.monotonic() - start, None)
+            with self._lock:
+                self._throttle_level = max(self._throttle_level - 1, 0)
+            return result
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
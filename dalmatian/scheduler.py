@@ -0,0 +1,148 @@
+import json
+import math
+import time
+from datetime import datetime
+
+# Decides when to checkpoint so that as little work as possible is lost to
+# interruptions and to checkpointing itself. Checkpointing every T seconds
+# costs C seconds per checkpoint, and an interruption arriving at rate 1/M
+# loses T/2 seconds of work on average. Young's interval sqrt(2CM) balances
+# the two; Daly's refinement sqrt(2CM) - C also accounts for the time spent
+# checkpointing, and is what is used here.
+#
+# J. W. Young, "A first order approximation to the optimum checkpoint
+# interval", 1974. J. T. Daly, "A higher order estimate of the optimum
+# checkpoint interval for restart dumps", 2006.
+
+HOUR = 3600
+# Interruptions per hour when nothing better is known: one every 20 hours
+DEFAULT_HAZARD_RATE = 0.05
+DEFAULT_MIN_INTERVAL = 0
+DEFAULT_MAX_INTERVAL = 30 * 60
+# Weight of the newest measurement in the running checkpoint cost
+COST_SMOOTHING = 0.3
+
+
+def young_daly_interval(cost, mtbf):
+    # The optimal number of seconds between checkpoints that each take cost
+    # seconds, with mtbf seconds between interruptions on average
+    if cost <= 0:
+        return 0.0
+    if cost >= 2 * mtbf:
+        return mtbf
+    return math.sqrt(2 * cost * mtbf) - cost
+
+
+def _parse_timestamp(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+
+
+def hazard_from_price_history(paths, max_price):
+    # Estimates interruptions per hour from spot price history, as saved by
+    # `aws ec2 describe-spot-price-history > history.json`. Every time the
+    # price rises above max_price counts as an interruption. Each zone and
+    # instance type is its own series. Histories without any are only known
+    # to have fewer than one per observed period, so that is what is returned.
+    if isinstance(paths, str):
+        paths = [paths]
+    series = {}
+    for path in paths:
+        with open(path) as f:
+            history = json.load(f)
+        if isinstance(history, dict):
+            history = history["SpotPriceHistory"]
+        for record in history:
+            key = (
+                record.get("AvailabilityZone"),
+                record.get("InstanceType"),
+                record.get("ProductDescription"),
+            )
+            series.setdefault(key, []).append(
+                (_parse_timestamp(record["Timestamp"]), float(record["SpotPrice"]))
+            )
+
+    max_price = float(max_price)
+    interruptions = 0
+    observed = 0.0
+    for prices in series.values():
+        prices.sort()
+        observed += prices[-1][0] - prices[0][0]
+        for (_, before), (_, after) in zip(prices, prices[1:]):
+            if before <= max_price < after:
+                interruptions += 1
+    if observed <= 0:
+        raise ValueError("Spot price history covers no time")
+    return max(interruptions, 1) / (observed / HOUR)
+
+
+class CheckpointScheduler:
+    # Tracks the time since the last checkpoint and what checkpoints cost,
+    # and says whether one is due. The first call is always due, which is
+    # how the cost gets measured in the first place.
+
+    def __init__(
+        self,
+        hazard_rate=DEFAULT_HAZARD_RATE,
+        min_interval=DEFAULT_MIN_INTERVAL,
+        max_interval=DEFAULT_MAX_INTERVAL,
+        clock=time.monotonic,
+    ):
+        self.hazard_rate = hazard_rate
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.cost = None
+        self.upload_time = None
+        self.last_checkpoint = None
+        self.last_step = None
+
+    @property
+    def mtbf(self):
+        if not self.hazard_rate:
+            return math.inf
+        return HOUR / self.hazard_rate
+
+    def interval(self):
+        # Seconds to leave between checkpoints. Background checkpoints
+        # cannot usefully be taken faster than they upload, since queued
+        # ones are skipped in favour of newer ones.
+        if self.cost is None:
+            return 0.0
+        interval = young_daly_interval(self.cost, self.mtbf)
+        if self.upload_time is not None:
+            interval = max(interval, self.upload_time)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def due(self, step=None):
+        if step is not None and step == self.last_step:
+            return False
+        if self.last_checkpoint is None:
+            return True
+        return self.clock() - self.last_checkpoint >= self.interval()
+
+    def record(self, cost, step=None, upload_time=None):
+        # cost is how long training was held up by the checkpoint, and
+        # upload_time how long a background checkpoint took to land
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost += COST_SMOOTHING * (cost - self.cost)
+        if upload_time is not None:
+            self.upload_time = upload_time
+        self.last_checkpoint = self.clock()
+        self.last_step = step
+
+    def summary(self):
+        return {
+            "hazard_rate": self.hazard_rate,
+            "cost": self.cost,
+            "interval": self.interval(),
+            "since_checkpoint": (
+                None
+                if self.last_checkpoint is None
+                else self.clock() - self.last_checkpoint
+            ),
+            "last_step": self.last_step,
+        }
@@ -0,0 +1,377 @@
+import bisect
+import io
+import itertools
+import pickle
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Every value is encoded by a codec, and starts with a small header recording
+# which one so that it can be decoded without being told:
+#
+#   MAGIC | codec code | encoded value
+#
+# Values written before codecs existed have no header and are either plain
+# pickles or a buffer container (see below) without the codec header.
+
+MAGIC = b"DLMC"
+_CODEC_HEADER = struct.Struct("<4sB")
+
+# Values holding large arrays are stored in a small container rather than as
+# a plain pickle. The pickle stream only describes the objects, and the array
+# data is taken out-of-band (pickle protocol 5) and laid out after it, so it
+# is copied exactly once on save and not at all on load: arrays are rebuilt
+# directly on top of the downloaded bytes.
+#
+#   CONTAINER_MAGIC | buffer count | pickle length |
+#   (offset, length) per buffer | pickle | buffers, each aligned
+#
+# Offsets are relative to the start of the container.
+
+CONTAINER_MAGIC = b"DLMZ"
+PROTOCOL = 5
+BUFFER_ALIGNMENT = 64
+# Buffers smaller than this are cheaper to leave inside the pickle stream
+MIN_OUT_OF_BAND_SIZE = 4096
+
+_CONTAINER_HEADER = struct.Struct("<4sIQ")
+_BUFFER = struct.Struct("<QQ")
+
+
+class Codec:
+    name = None
+    code = None
+
+    def accepts(self, obj):
+        return True
+
+    def encode(self, obj, prefix):
+        # Returns a bytes-like object starting with prefix. Codecs write the
+        # prefix themselves so that large encodings are not copied to add it.
+        raise NotImplementedError
+
+    def encode_segments(self, obj, prefix):
+        # Returns the encoding as a list of buffers to be read one after the
+        # other, for codecs that can avoid copying large ones
+        return [self.encode(obj, prefix)]
+
+    def decode(self, view):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    # Plain protocol 5 pickles, with array data kept in-band
+    name = "pickle"
+    code = 1
+
+    def encode(self, obj, prefix):
+        stream = io.BytesIO()
+        stream.write(prefix)
+        _Pickler(stream, protocol=PROTOCOL).dump(obj)
+        return stream.getvalue()
+
+    def decode(self, view):
+        return pickle.loads(view)
+
+
+class BufferCodec(Codec):
+    # Protocol 5 pickles with array data laid out raw in a buffer container.
+    # Falls back to a plain pickle when there are no large buffers.
+    name = "buffers"
+    code = 2
+
+    def encode(self, obj, prefix):
+        segments = self.encode_segments(obj, prefix)
+        if len(segments) == 1:
+            return segments[0]
+        return Segments(segments).join()
+
+    def encode_segments(self, obj, prefix):
+        buffers = []
+
+        def out_of_band(buffer):
+            view = buffer.raw()
+            if view.nbytes < MIN_OUT_OF_BAND_SIZE:
+                return True  # serialize in-band
+            buffers.append(view)
+            return False
+
+        stream = io.BytesIO()
+        stream.write(prefix)
+        _Pickler(stream, protocol=PROTOCOL, buffer_callback=out_of_band).dump(obj)
+        if not buffers:
+            return [stream.getvalue()]
+        pickled = stream.getbuffer()[len(prefix) :]
+        return _container_segments(pickled, buffers, prefix)
+
+    def decode(self, view):
+        if bytes(view[: len(CONTAINER_MAGIC)]) == CONTAINER_MAGIC:
+            return _unpack_container(view)
+        return pickle.loads(view)
+
+
+class MsgpackCodec(Codec):
+    # For parameters made only of plain values (numbers, strings, bytes, lists
+    # and string-keyed dicts). These decode anywhere, without needing the
+    # modules that pickles refer to.
+    name = "msgpack"
+    code = 3
+    # Checking every element of huge lists costs more than msgpack saves
+    MAX_ITEMS = 10000
+
+    def accepts(self, obj):
+        return msgpack is not None and _is_plain(obj, [self.MAX_ITEMS])
+
+    def encode(self, obj, prefix):
+        return prefix + msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, view):
+        return msgpack.unpackb(view, raw=False)
+
+
+CODECS = {}
+_BY_CODE = {}
+
+
+def register_codec(codec):
+    assert codec.code not in _BY_CODE, "Codec code already in use"
+    CODECS[codec.name] = codec
+    _BY_CODE[codec.code] = codec
+
+
+register_codec(PickleCodec())
+register_codec(BufferCodec())
+register_codec(MsgpackCodec())
+
+
+def get_codec(name):
+    if name != "auto" and name not in CODECS:
+        raise ValueError(
+            "Unknown codec {}, choose from auto, {}".format(
+                name, ", ".join(sorted(CODECS))
+            )
+        )
+    return name
+
+
+def choose_codec(obj):
+    msgpack_codec = CODECS["msgpack"]
+    if msgpack_codec.accepts(obj):
+        return msgpack_codec
+    return CODECS["buffers"]
+
+
+def _resolve_codec(obj, codec):
+    codec = choose_codec(obj) if codec == "auto" else CODECS[codec]
+    if not codec.accepts(obj):
+        codec = CODECS["buffers"]
+    return codec
+
+
+def dumps(obj, codec="auto"):
+    codec = _resolve_codec(obj, codec)
+    return codec.encode(obj, _CODEC_HEADER.pack(MAGIC, codec.code))
+
+
+def dumps_segments(obj, codec="auto"):
+    # The same encoding as dumps, as Segments whose array data is still the
+    # arrays' own memory. The arrays must not change while it is in use.
+    codec = _resolve_codec(obj, codec)
+    prefix = _CODEC_HEADER.pack(MAGIC, codec.code)
+    return Segments(codec.encode_segments(obj, prefix))
+
+
+class Segments:
+    # A value held as buffers that follow on from one another, e.g. an
+    # encoded pickle followed by the memory of the arrays it refers to, so
+    # that it can be hashed and uploaded without first being copied into one
+    # buffer. Slices within one buffer are views of it, and only slices that
+    # span buffers are copied.
+
+    def __init__(self, buffers):
+        self.buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+        self._offsets = list(
+            itertools.accumulate([0] + [buffer.nbytes for buffer in self.buffers])
+        )
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(len(self))
+        assert step == 1, "Segments only support contiguous slices"
+        pieces = []
+        i = bisect.bisect_right(self._offsets, start) - 1
+        while start < stop and i < len(self.buffers):
+            offset = self._offsets[i]
+            piece = self.buffers[i][start - offset : stop - offset]
+            pieces.append(piece)
+            start += piece.nbytes
+            i += 1
+        if len(pieces) == 1:
+            return pieces[0]
+        return b"".join(pieces)
+
+    def join(self):
+        data = bytearray(len(self))
+        for buffer, offset in zip(self.buffers, self._offsets):
+            data[offset : offset + buffer.nbytes] = buffer
+        return data
+
+
+def sliceable(data):
+    # A bytes-like object or Segments, as something that can be sliced into
+    # bytes-like objects without copying it
+    if isinstance(data, Segments):
+        return data
+    return memoryview(data).cast("B")
+
+
+def buffers_of(data):
+    # The buffers making up a bytes-like object or Segments, in order
+    if isinstance(data, Segments):
+        return data.buffers
+    return [memoryview(data).cast("B")]
+
+
+def loads(data):
+    # data should be a writable buffer (e.g. a bytearray) for arrays loaded
+    # from it to be writable
+    view = memoryview(data)
+    magic = bytes(view[: len(MAGIC)])
+    if magic == CONTAINER_MAGIC:
+        return _unpack_container(view)
+    if magic != MAGIC:
+        return pickle.loads(view)
+    _, code = _CODEC_HEADER.unpack_from(view, 0)
+    if code not in _BY_CODE:
+        raise ValueError("Value was encoded with unknown codec {}".format(code))
+    return _BY_CODE[code].decode(view[_CODEC_HEADER.size :])
+
+
+def buffer_layout(data):
+    # Returns the (offset, length) of every out-of-band buffer in an encoded
+    # value, or nothing if its arrays are not stored out-of-band. The headers
+    # are all in the first of the buffers of Segments.
+    view = buffers_of(data)[0]
+    start = 0
+    if bytes(view[: len(MAGIC)]) == MAGIC:
+        _, code = _CODEC_HEADER.unpack_from(view, 0)
+        if code != BufferCodec.code:
+            return []
+        start = _CODEC_HEADER.size
+    if bytes(view[start : start + len(CONTAINER_MAGIC)]) != CONTAINER_MAGIC:
+        return []
+    _, count, _ = _CONTAINER_HEADER.unpack_from(view, start)
+    layout = []
+    for i in range(count):
+        offset, length = _BUFFER.unpack_from(
+            view, start + _CONTAINER_HEADER.size + i * _BUFFER.size
+        )
+        layout.append((start + offset, length))
+    return layout
+
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # torch pickles tensors by saving their storage to an in-memory file.
+        # CPU tensors are instead handed over as numpy arrays sharing their
+        # memory, which protocol 5 can take out-of-band. torch is only looked
+        # up if something has already imported it.
+        torch = sys.modules.get("torch")
+        if torch is None or type(obj) not in (torch.Tensor, torch.nn.Parameter):
+            return NotImplemented
+        tensor = obj.detach().cpu()
+        # numpy has no bfloat16, but its bits fit in an int16 just as well
+        dtype = None
+        if tensor.dtype == torch.bfloat16:
+            tensor, dtype = tensor.view(torch.int16), "bfloat16"
+        try:
+            array = tensor.numpy()
+        except (TypeError, RuntimeError):
+            # e.g. sparse tensors, which numpy cannot represent
+            return NotImplemented
+        return _rebuild_tensor, (array, obj.requires_grad, dtype)
+
+
+def _rebuild_tensor(array, requires_grad, dtype=None):
+    import torch
+
+    tensor = torch.from_numpy(array)
+    if dtype is not None:
+        tensor = tensor.view(getattr(torch, dtype))
+    if requires_grad:
+        tensor.requires_grad_()
+    return tensor
+
+
+def _container_segments(pickled, buffers, prefix=b""):
+    # The container as the header and pickle, then each buffer followed by
+    # the padding that aligns the next
+    header_size = _CONTAINER_HEADER.size + _BUFFER.size * len(buffers)
+    offset = _align(header_size + len(pickled))
+    layout = []
+    for view in buffers:
+        layout.append((offset, view.nbytes))
+        offset = _align(offset + view.nbytes)
+
+    # The prefix goes in front of the container, which keeps the container
+    # itself aligned relative to its own start
+    head = bytearray(len(prefix) + layout[0][0])
+    head[: len(prefix)] = prefix
+    container = memoryview(head)[len(prefix) :]
+    _CONTAINER_HEADER.pack_into(
+        container, 0, CONTAINER_MAGIC, len(buffers), len(pickled)
+    )
+    for i, entry in enumerate(layout):
+        _BUFFER.pack_into(container, _CONTAINER_HEADER.size + i * _BUFFER.size, *entry)
+    container[header_size : header_size + len(pickled)] = pickled
+    segments = [head]
+    ends = [start for start, _ in layout[1:]] + [offset]
+    for (start, length), view, end in zip(layout, buffers, ends):
+        segments.append(view)
+        if end > start + length:
+            segments.append(bytes(end - start - length))
+    return segments
+
+
+def _pack_container(pickled, buffers, prefix=b""):
+    return Segments(_container_segments(pickled, buffers, prefix)).join()
+
+
+def _unpack_container(view):
+    _, count, pickle_size = _CONTAINER_HEADER.unpack_from(view, 0)
+    buffers = []
+    for i in range(count):
+        start, length = _BUFFER.unpack_from(
+            view, _CONTAINER_HEADER.size + i * _BUFFER.size
+        )
+        buffers.append(view[start : start + length])
+    header_size = _CONTAINER_HEADER.size + _BUFFER.size * count
+    return pickle.loads(view[header_size : header_size + pickle_size], buffers=buffers)
+
+
+def _is_plain(obj, budget):
+    budget[0] -= 1
+    if budget[0] < 0:
+        return False
+    if obj is None or type(obj) in (bool, float, str, bytes):
+        return True
+    if type(obj) is int:
+        return -(2 ** 63) <= obj < 2 ** 64
+    if type(obj) is list:
+        return all(_is_plain(item, budget) for item in obj)
+    if type(obj) is dict:
+        return all(
+            type(key) is str and _is_plain(value, budget)
+            for key, value in obj.items()
+        )
+    return False
+
+
+def _align(offset):
+    return -(-offset // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
@@ -0,0 +1,478 @@
+import contextlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+from botocore.exceptions import ClientError
+
+from . import clients
+from .manifest import digest
+from .transfer import TransferError, _check_status
+
+# Everything dalmatian stores goes through a storage backend. Keys are
+# "/"-separated names such as "{instance}-state/manifest". Backends raise on
+# failure, and the caller's Retrier decides what is worth retrying.
+#
+# setup(storage=...) takes a backend or a URL:
+#
+#   s3://{bucket}      S3, the default being s3://dalmatian
+#   file://{path}      a local or shared (NFS, Lustre) filesystem
+#   memory://          an in-memory store, for tests and benchmarks
+
+DEFAULT_BUCKET = "dalmatian"
+# DeleteObjects takes at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+UPLOADS_DIRECTORY = ".uploads"
+
+
+class StorageBackend:
+    # Whether other processes can see what this process stores, e.g. a
+    # forked child checkpointing on its behalf
+    shared = True
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        # Returns the whole object, or None if there is no such key
+        raise NotImplementedError
+
+    def get_range(self, key, start, end):
+        # Returns bytes start up to, but excluding, end
+        raise NotImplementedError
+
+    def size(self, key):
+        # Returns None if there is no such key
+        raise NotImplementedError
+
+    def list(self, prefix):
+        # Returns the size of every object whose key starts with prefix
+        raise NotImplementedError
+
+    def delete(self, keys):
+        # Missing keys are ignored
+        raise NotImplementedError
+
+    def create_multipart(self, key):
+        # Returns an upload id
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, number, data):
+        # Returns the part's ETag
+        raise NotImplementedError
+
+    def list_parts(self, key, upload_id):
+        # Returns {number: (etag, size)} for the parts uploaded so far, or
+        # None if the upload no longer exists
+        raise NotImplementedError
+
+    def complete_multipart(self, key, upload_id, parts):
+        # parts maps part numbers to their ETags
+        raise NotImplementedError
+
+    def abort_multipart(self, key, upload_id):
+        raise NotImplementedError
+
+    def path(self, key):
+        # A path or URL other libraries can write key to, if there is one
+        return None
+
+    def after_fork(self):
+        # Called in a forked child before it uses the backend, to replace
+        # anything it must not share with its parent, e.g. open connections
+        pass
+
+
+class S3Backend(StorageBackend):
+    # Uses the process-wide S3 client unless given one, so every backend and
+    # thread shares one connection pool
+
+    def __init__(self, bucket=DEFAULT_BUCKET, client=None):
+        self.bucket = bucket
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or clients.client("s3")
+
+    def put(self, key, data):
+        response = self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        _check_status(response, 200)
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if _is_missing(e):
+                return None
+            raise e
+        # Reading the body is part of the call, so that a connection dropping
+        # midway is retried along with the request
+        return response["Body"].read()
+
+    def get_range(self, key, start, end):
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=key, Range="bytes={}-{}".format(start, end - 1)
+        )
+        _check_status(response, 200, 206)
+        return response["Body"].read()
+
+    def size(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if _is_missing(e):
+                return None
+            raise e
+        return response["ContentLength"]
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        return {
+            item["Key"]: item["Size"]
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+            for item in page.get("Contents", [])
+        }
+
+    def delete(self, keys):
+        keys = sorted(keys)
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in keys[i : i + DELETE_BATCH_SIZE]
+                    ],
+                    "Quiet": True,
+                },
+            )
+            _check_status(response, 200)
+            errors = response.get("Errors")
+            if errors:
+                raise TransferError(
+                    "Failed to delete {}: {}".format(
+                        errors[0]["Key"], errors[0].get("Message")
+                    )
+                )
+
+    def create_multipart(self, key):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        return response["UploadId"]
+
+    def upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        _check_status(response, 200)
+        return response["ETag"]
+
+    def list_parts(self, key, upload_id):
+        paginator = self.client.get_paginator("list_parts")
+        try:
+            return {
+                part["PartNumber"]: (part["ETag"], part["Size"])
+                for page in paginator.paginate(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id
+                )
+                for part in page.get("Parts", [])
+            }
+        except ClientError as e:
+            # The upload was aborted or expired in the meantime. Anything
+            # else, e.g. throttling, is left for the retrier.
+            if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+                return None
+            raise e
+
+    def complete_multipart(self, key, upload_id, parts):
+        response = self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": parts[number]}
+                    for number in sorted(parts)
+                ]
+            },
+        )
+        _check_status(response, 200)
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id
+        )
+
+    def path(self, key):
+        return "s3://{}/{}".format(self.bucket, key)
+
+    def after_fork(self):
+        # boto clients are not safe to use across a fork, since the child
+        # would share its parent's pooled connections
+        if self._client is None:
+            clients.reset()
+
+
+class LocalBackend(StorageBackend):
+    # Stores objects as files under a directory, e.g. on a shared NFS or
+    # Lustre volume. Objects are written to a temporary file, fsynced and
+    # renamed into place, so readers never see a partial object. Reads are
+    # served from a private memory map, so loading an object does not copy it
+    # until it is written to. Multipart uploads keep their parts under
+    # {directory}/.uploads until they are completed.
+
+    def __init__(self, directory):
+        self.root = os.path.abspath(directory)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _upload_path(self, upload_id, number=None):
+        path = os.path.join(self.root, UPLOADS_DIRECTORY, upload_id)
+        if number is None:
+            return path
+        return os.path.join(path, str(number))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_durably(path, data)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return bytearray()
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def get_range(self, key, start, end):
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            data = bytearray(end - start)
+            count = f.readinto(data)
+        if count != len(data):
+            raise TransferError("Object {} ended early".format(key))
+        return data
+
+    def size(self, key):
+        # A key can also be the directory holding the keys nested under it
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
+    def list(self, prefix):
+        sizes = {}
+        for directory, subdirectories, files in os.walk(self.root):
+            if directory == self.root and UPLOADS_DIRECTORY in subdirectories:
+                subdirectories.remove(UPLOADS_DIRECTORY)
+            relative = os.path.relpath(directory, self.root)
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                key = name if relative == "." else "/".join(
+                    relative.split(os.sep) + [name]
+                )
+                if key.startswith(prefix):
+                    sizes[key] = os.path.getsize(os.path.join(directory, name))
+        return sizes
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+
+    def create_multipart(self, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_path(upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        if not os.path.isdir(self._upload_path(upload_id)):
+            raise TransferError("No such upload {}".format(upload_id))
+        write_durably(self._upload_path(upload_id, number), data)
+        return digest(data)
+
+    def list_parts(self, key, upload_id):
+        if not os.path.isdir(self._upload_path(upload_id)):
+            return None
+        parts = {}
+        for name in os.listdir(self._upload_path(upload_id)):
+            if name.endswith(".tmp"):
+                continue
+            data = read_file(self._upload_path(upload_id, name))
+            parts[int(name)] = (digest(data), len(data))
+        return parts
+
+    def complete_multipart(self, key, upload_id, parts):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with replacing(path) as f:
+            for number in sorted(parts):
+                with open(self._upload_path(upload_id, number), "rb") as part:
+                    shutil.copyfileobj(part, f)
+        self.abort_multipart(key, upload_id)
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def path(self, key):
+        return self._path(key)
+
+
+class InMemoryBackend(StorageBackend):
+    # Keeps objects in a dict. Nothing survives the process, which makes it
+    # useful for tests and for benchmarking everything but the network.
+
+    shared = False
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        data = bytes(data)
+        with self._lock:
+            self.objects[key] = data
+
+    def get(self, key):
+        with self._lock:
+            return self.objects.get(key)
+
+    def get_range(self, key, start, end):
+        with self._lock:
+            return self.objects[key][start:end]
+
+    def size(self, key):
+        with self._lock:
+            data = self.objects.get(key)
+        return None if data is None else len(data)
+
+    def list(self, prefix):
+        with self._lock:
+            return {
+                key: len(data)
+                for key, data in self.objects.items()
+                if key.startswith(prefix)
+            }
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self.objects.pop(key, None)
+
+    def create_multipart(self, key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        data = bytes(data)
+        with self._lock:
+            if upload_id not in self.uploads:
+                raise TransferError("No such upload {}".format(upload_id))
+            self.uploads[upload_id][number] = data
+        return digest(data)
+
+    def list_parts(self, key, upload_id):
+        with self._lock:
+            parts = self.uploads.get(upload_id)
+            if parts is None:
+                return None
+            return {
+                number: (digest(data), len(data)) for number, data in parts.items()
+            }
+
+    def complete_multipart(self, key, upload_id, parts):
+        with self._lock:
+            uploaded = self.uploads.pop(upload_id)
+            self.objects[key] = b"".join(uploaded[number] for number in sorted(parts))
+
+    def abort_multipart(self, key, upload_id):
+        with self._lock:
+            self.uploads.pop(upload_id, None)
+
+
+def open_storage(url=None):
+    if url is None:
+        return S3Backend()
+    if isinstance(url, StorageBackend):
+        return url
+    if url.startswith("s3://"):
+        return S3Backend(url[len("s3://") :].strip("/"))
+    if url.startswith("memory://"):
+        return InMemoryBackend()
+    if url.startswith("file://"):
+        url = url[len("file://") :]
+    return LocalBackend(url)
+
+
+def write_durably(path, data):
+    # Written to a temporary file through a memory map, fsynced, then renamed
+    # into place, so that a reader never sees a partially written file
+    data = memoryview(data).cast("B")
+    size = len(data)
+    with replacing(path) as f:
+        f.truncate(size)
+        if size:
+            with mmap.mmap(f.fileno(), size) as mapped:
+                mapped[:] = data
+                mapped.flush()
+
+
+@contextlib.contextmanager
+def replacing(path):
+    # Yields a temporary file next to path, which is fsynced and renamed over
+    # path once written, or removed if writing fails. Its name is unique,
+    # since on shared filesystems several processes may write the same key at
+    # once, and ends in .tmp so that listings skip it.
+    fd, temporary = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path)
+    )
+    try:
+        with os.fdopen(fd, "wb+") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+    fsync_directory(os.path.dirname(path))
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        data = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(data)
+    return data
+
+
+def _is_missing(error):
+    return error.response.get("Error", {}).get("Code") in (
+        "NoSuchKey",
+        "NotFound",
+        "404",
+    )
@@ -0,0 +1,346 @@
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .retry import Retrier, RetryError
+
+MB = 1024 * 1024
+# S3 rejects multipart parts smaller than 5MB, except for the last one
+MIN_PART_SIZE = 5 * MB
+DEFAULT_PART_SIZE = 16 * MB
+DEFAULT_CONCURRENCY = 8
+
+
+class TransferConfig:
+    def __init__(self, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        assert part_size >= MIN_PART_SIZE, "part_size must be at least 5MB"
+        assert concurrency >= 1, "concurrency must be at least 1"
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    def slots(self):
+        # Bounds the requests in flight at once. Readers and writers sharing
+        # one between them make at most `concurrency` requests in total,
+        # rather than `concurrency` each.
+        return threading.BoundedSemaphore(self.concurrency)
+
+
+class ResumableUploads:
+    # Remembers multipart uploads that failed part way through, so that the
+    # next attempt at writing the same key carries on from the parts S3
+    # already has instead of starting again from the first byte. This relies
+    # on the same key always being written with the same contents, which
+    # holds for digest-named objects.
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def suspend(self, key, upload_id, part_size):
+        with self._lock:
+            self._uploads[key] = (upload_id, part_size)
+
+    def resume(self, key):
+        # Returns the (upload_id, part_size) of the upload suspended for key,
+        # if there is one, which is then no longer tracked here
+        with self._lock:
+            return self._uploads.pop(key, None)
+
+    def pop_all(self):
+        with self._lock:
+            uploads, self._uploads = self._uploads, {}
+        return uploads
+
+
+class MultipartWriter(io.RawIOBase):
+    # A write-only file object that uploads to storage as data arrives. Writes
+    # are cut into parts which are uploaded concurrently, and at most
+    # `concurrency` parts are in flight at once, across every writer sharing
+    # `slots`. Objects that fit in a single part fall back to one put call.
+    # Each request is retried on its own, and with `resumable` set a failed
+    # upload is kept open to be resumed by the next writer for the same key.
+    # `check`, if given, is called before each part is uploaded and may raise
+    # to stop the upload.
+
+    def __init__(
+        self,
+        storage,
+        key,
+        config=None,
+        retrier=None,
+        resumable=None,
+        check=None,
+        slots=None,
+    ):
+        self.storage = storage
+        self.key = key
+        self.config = config or TransferConfig()
+        self.retrier = retrier or Retrier()
+        self.resumable = resumable
+        self.check = check
+        self.upload_id = None
+        self._existing = {}
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._parts = {}
+        self._futures = []
+        self._executor = None
+        self._slots = slots or self.config.slots()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed MultipartWriter")
+        data = memoryview(data).cast("B")
+        count = len(data)
+        part_size = self.config.part_size
+        # Large writes are sliced straight into parts, so the buffer never
+        # grows past a single part
+        while data:
+            take = part_size - len(self._buffer)
+            self._buffer += data[:take]
+            data = data[take:]
+            if len(self._buffer) == part_size:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+        self.bytes_written += count
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self._put_single(bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                self._complete()
+        except (TransferError, RetryError) as e:
+            self.suspend()
+            raise e
+        except BaseException:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        super().close()
+
+    def suspend(self):
+        # Stops writing but leaves the multipart upload open for a later
+        # writer to resume, if resuming is enabled
+        if self.resumable is None or self.upload_id is None:
+            self.abort()
+            return
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.resumable.suspend(self.key, self.upload_id, self.config.part_size)
+        self.upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        # Discards everything written so far. Once aborted, closing the writer
+        # (including when it is garbage collected) uploads nothing.
+        for future in self._futures:
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            self._abort_upload(self.upload_id)
+            self.upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def _abort_upload(self, upload_id):
+        self.retrier.call(
+            "abort_multipart_upload", self.storage.abort_multipart, self.key, upload_id
+        )
+
+    def _put_single(self, body):
+        self._check()
+        with self._slots:
+            self.retrier.call("put_object", self.storage.put, self.key, body)
+
+    def _start(self):
+        upload = None if self.resumable is None else self.resumable.resume(self.key)
+        if upload is not None:
+            upload_id, part_size = upload
+            if part_size == self.config.part_size:
+                self.upload_id = upload_id
+            else:
+                # Its parts do not line up with ours, so they are no use
+                self._abort_upload(upload_id)
+        if self.upload_id is not None:
+            existing = self.retrier.call(
+                "list_parts", self.storage.list_parts, self.key, self.upload_id
+            )
+            if existing is None:
+                # Most likely the upload was aborted or expired in the meantime
+                self.upload_id = None
+            else:
+                self._existing = existing
+        if self.upload_id is None:
+            self.upload_id = self.retrier.call(
+                "create_multipart_upload", self.storage.create_multipart, self.key
+            )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config.concurrency, thread_name_prefix="dalmatian-put"
+        )
+
+    def _submit(self, body):
+        if self.upload_id is None:
+            self._start()
+        self._raise_failed()
+        part_number = len(self._futures) + 1
+        if self._existing.get(part_number, (None, None))[1] == len(body):
+            # Already uploaded by an earlier, failed attempt
+            future = Future()
+            future.set_result(None)
+            self._parts[part_number] = self._existing[part_number][0]
+            self._futures.append(future)
+            return
+        # Blocks once `concurrency` parts are in flight, which bounds memory
+        self._slots.acquire()
+        try:
+            self._check()
+        except BaseException:
+            self._slots.release()
+            raise
+        future = self._executor.submit(self._upload_part, part_number, body)
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, body):
+        try:
+            self._check()
+            self._parts[part_number] = self.retrier.call(
+                "upload_part",
+                self.storage.upload_part,
+                self.key,
+                self.upload_id,
+                part_number,
+                body,
+            )
+        finally:
+            self._slots.release()
+
+    def _check(self):
+        if self.check is not None:
+            self.check()
+
+    def _raise_failed(self):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _complete(self):
+        for future in self._futures:
+            future.result()
+        self.retrier.call(
+            "complete_multipart_upload",
+            self.storage.complete_multipart,
+            self.key,
+            self.upload_id,
+            dict(self._parts),
+        )
+        self.upload_id = None
+
+
+class RangeReader(io.RawIOBase):
+    # A read-only file object over a stored object which fetches byte ranges in
+    # parallel, keeping up to `concurrency` ranges ahead of the reader. Ranges
+    # are handed out in order, so memory stays bounded by roughly
+    # concurrency * part_size regardless of the object size. Readers sharing
+    # `slots` have at most `concurrency` requests in flight between them.
+
+    def __init__(self, storage, key, size, config=None, retrier=None, slots=None):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.config = config or TransferConfig()
+        self.retrier = retrier or Retrier()
+        self._slots = slots or self.config.slots()
+        self._next_offset = 0
+        self._pending = []
+        self._current = memoryview(b"")
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config.concurrency, thread_name_prefix="dalmatian-get"
+        )
+        self._fill()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._current:
+            if not self._pending:
+                return 0
+            self._current = memoryview(self._pending.pop(0).result())
+            self._fill()
+        count = min(len(buffer), len(self._current))
+        buffer[:count] = self._current[:count]
+        self._current = self._current[count:]
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._pending = []
+        self._current = memoryview(b"")
+        super().close()
+
+    def _fill(self):
+        while (
+            len(self._pending) < self.config.concurrency
+            and self._next_offset < self.size
+        ):
+            start = self._next_offset
+            end = min(start + self.config.part_size, self.size)
+            self._pending.append(self._executor.submit(self._get_range, start, end))
+            self._next_offset = end
+
+    def _get_range(self, start, end):
+        with self._slots:
+            return self.retrier.call(
+                "get_range", self.storage.get_range, self.key, start, end
+            )
+
+
+def open_reader(storage, key, size, config=None, retrier=None, slots=None):
+    config = config or TransferConfig()
+    raw = RangeReader(storage, key, size, config, retrier, slots)
+    return io.BufferedReader(raw, buffer_size=min(config.part_size, 1 * MB))
+
+
+def download(storage, key, size, config=None, retrier=None, slots=None):
+    # Reads a whole object into a single preallocated bytearray, fetching
+    # ranges in parallel
+    data = bytearray(size)
+    view = memoryview(data)
+    with RangeReader(storage, key, size, config, retrier, slots) as reader:
+        offset = 0
+        while offset < size:
+            count = reader.readinto(view[offset:])
+            if not count:
+                raise TransferError("Object {} ended early".format(key))
+            offset += count
+    return data
+
+
+class TransferError(IOError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        # Used to tell retryable failures apart, see retry.classify
+        self.status = status
+
+
+def _check_status(response, *expected):
+    status = response["ResponseMetadata"]["HTTPStatusCode"]
+    if status not in expected:
+        raise TransferError("Unexpected HTTP status {}".format(status), status)
@@ -0,0 +1,108 @@
+import atexit
+import threading
+
+PENDING = "pending"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+# A queued checkpoint is superseded when a newer one is submitted before the
+# uploader got around to it. Only the latest state is worth uploading.
+SUPERSEDED = "superseded"
+
+
+class CheckpointHandle:
+    def __init__(self, job):
+        self._job = job
+        self._status = PENDING
+        self._finished = threading.Event()
+        self.error = None
+
+    @property
+    def status(self):
+        return self._status
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        # Returns True if the checkpoint finished within the timeout, whether
+        # or not it was successful. Check status or error for the outcome.
+        return self._finished.wait(timeout)
+
+    def _run(self):
+        self._status = UPLOADING
+        try:
+            self._job()
+        except Exception as e:
+            self.error = e
+            self._finish(FAILED)
+        else:
+            self._finish(DONE)
+
+    def _finish(self, status):
+        self._status = status
+        self._job = None
+        self._finished.set()
+
+
+class BackgroundUploader:
+    def __init__(self, name="dalmatian-uploader"):
+        self._condition = threading.Condition()
+        self._queued = None
+        self._active = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, job):
+        handle = CheckpointHandle(job)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Uploader has been closed")
+            if self._queued is not None:
+                self._queued._finish(SUPERSEDED)
+            self._queued = handle
+            self._condition.notify_all()
+        return handle
+
+    def discard_queued(self):
+        # Drops the queued checkpoint, if any, for one that is about to be
+        # taken synchronously
+        with self._condition:
+            if self._queued is not None:
+                self._queued._finish(SUPERSEDED)
+                self._queued = None
+
+    def pending(self):
+        with self._condition:
+            return [h for h in (self._active, self._queued) if h is not None]
+
+    def flush(self, timeout=None):
+        # Blocks until everything submitted so far has been uploaded
+        for handle in self.pending():
+            if not handle.wait(timeout):
+                return False
+        return True
+
+    def close(self, timeout=None):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._queued is None and not self._closed:
+                    self._condition.wait()
+                if self._queued is None:
+                    return
+                handle, self._queued = self._queued, None
+                self._active = handle
+            handle._run()
+            with self._condition:
+                self._active = None
@@ -33,8 +33,10 @@ model.fit(x_train,
           initial_epoch=initial_epoch,
           epochs = 10,
           # We pass in a Checkpoint as a callback for keras. Checkpoint takes
-          # the dalm.instance object as a parameter which it uses to update S3
-          callbacks=[keras_shim.Checkpoint(dalm.instance)])
+          # the dalm.instance object as a parameter which it uses to update S3.
+          # Besides every epoch, it also checkpoints every 5 minutes in the
+          # background.
+          callbacks=[keras_shim.Checkpoint(dalm.instance, every_seconds=300)])
 ###################
 
 model.evaluate(x_test, y_test)
@@ -5,6 +5,8 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import datasets, transforms
 from dalmatian import dalmatian as dalm
+import dalmatian.frameworks.pytorch as pytorch_shim
+from dalmatian.data import ResumableLoader, ResumableSampler
 
 class Net(nn.Module):
     def __init__(self):
@@ -24,7 +26,7 @@ class Net(nn.Module):
         x = self.fc2(x)
         return F.log_softmax(x, dim=1)
 
-def train(args, model, device, train_loader, optimizer, epoch):
+def train(args, model, device, train_loader, optimizer, epoch, checkpoint):
     model.train()
     for batch_idx, (data, target) in enumerate(train_loader):
         data, target = data.to(device), target.to(device)
@@ -37,6 +39,10 @@ def train(args, model, device, train_loader, optimizer, epoch):
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(data), len(train_loader.dataset),
                 100. * batch_idx / len(train_loader), loss.item()))
+        if batch_idx % args.checkpoint_interval == 0:
+            # Records the position in the epoch, so a restart carries on
+            # from the next batch
+            checkpoint.save(epoch=epoch)
 
 def test(args, model, device, test_loader):
     model.eval()
@@ -74,6 +80,8 @@ def main():
                         help='random seed (default: 1)')
     parser.add_argument('--log-interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status')
+    parser.add_argument('--checkpoint-interval', type=int, default=100, metavar='N',
+                        help='how many batches to wait before checkpointing')
     args = parser.parse_args()
     use_cuda = not args.no_cuda and torch.cuda.is_available()
 
@@ -82,13 +90,15 @@ def main():
     device = torch.device("cuda" if use_cuda else "cpu")
 
     kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
+    train_set = datasets.MNIST('../data', train=True, download=True,
+                               transform=transforms.Compose([
+                                   transforms.ToTensor(),
+                                   transforms.Normalize((0.1307,), (0.3081,))
+                               ]))
+    # Shuffles like shuffle=True, but can resume partway through an epoch
+    sampler = ResumableSampler(len(train_set), seed=args.seed)
     train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('../data', train=True, download=True,
-                       transform=transforms.Compose([
-                           transforms.ToTensor(),
-                           transforms.Normalize((0.1307,), (0.3081,))
-                       ])),
-        batch_size=args.batch_size, shuffle=True, **kwargs)
+        train_set, batch_size=args.batch_size, sampler=sampler, **kwargs)
     test_loader = torch.utils.data.DataLoader(
         datasets.MNIST('../data', train=False, transform=transforms.Compose([
                            transforms.ToTensor(),
@@ -103,30 +113,22 @@ def main():
     #### Dalmatian ####
     dalm.setup() # Initialize dalmatian
 
-    # Load any existing state
-    stored_state = dalm.get_params()
-    start_epoch = stored_state.get('epoch', 1)
-    if 'model' in stored_state:
-        print("Loading model")
-        model.load_state_dict(stored_state['model'])
-    if 'optimizer' in stored_state:
-        print("Loading optimizer")
-        optimizer.load_state_dict(stored_state['optimizer'])
-
-    # Watch the model and the optimizer parameters
-    dalm.watch_param('model', model.state_dict())
-    dalm.watch_param('optimizer', optimizer.state_dict())
+    # The checkpoint covers the model, the optimizer, the random number
+    # generators and the position in the data. Restoring loads the weights
+    # straight into the model.
+    checkpoint = pytorch_shim.Checkpoint(dalm.instance, model, optimizer,
+                                         sampler=sampler)
+    restored = checkpoint.restore()
+    # An interrupted epoch is resumed where it left off
+    start_epoch = restored['epoch'] if restored else 1
 
     ###################
 
     for epoch in range(start_epoch, args.epochs + 1):
-        # Epoch is not a mutable that we can watch, so we update it every time
-        # the epoch changes using store_params
-        dalm.store_params({'epoch': epoch})
-        # Declaring a checkpoint triggers a save of all watched data structures
-        # and stored params
-        dalm.checkpoint()
-        train(args, model, device, train_loader, optimizer, epoch)
+        sampler.set_epoch(epoch)
+        train(args, model, device, ResumableLoader(train_loader, sampler),
+              optimizer, epoch, checkpoint)
+        checkpoint.save(epoch=epoch)
         test(args, model, device, test_loader)
 
 
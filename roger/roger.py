@@ -11,9 +11,10 @@ import fabric
 from fabric import Connection
 import invoke
 from invoke.watchers import StreamWatcher
-import boto3 as boto
 from botocore.exceptions import ClientError
 
+from dalmatian.clients import resource, s3_transfer_config
+
 
 ### Monkey Patching for Invoke ###
 
@@ -96,8 +97,8 @@ def local_path(path):
 
 class Instance:
     def __init__(self):
-        self.ec2 = boto.resource("ec2")
-        self.s3 = boto.resource("s3")
+        self.ec2 = resource("ec2")
+        self.s3 = resource("s3")
         self.bucket = self.s3.Bucket(DEFAULT_BUCKET)
         self.security_group_ids = (
             self.ec2.security_groups.all()
@@ -127,7 +128,11 @@ class Instance:
         # TODO fail loudly here when the package zip can't be found
         # TODO add package validation
         # TODO should we split this out somehow?
-        self.bucket.upload_file(package_path, "packages/{}.zip".format(self.name))
+        self.bucket.upload_file(
+            package_path,
+            "packages/{}.zip".format(self.name),
+            Config=s3_transfer_config(),
+        )
 
     def build_run_script(self):
         pass
@@ -212,6 +217,7 @@ class Instance:
             data_path,
             "data-packages/{}.zip".format(self.name),
             Callback=upload_callback,
+            Config=s3_transfer_config(),
         )
         log("Upload complete")
 
@@ -423,8 +429,6 @@ class Saveable:
 
 
 class User(Saveable):
-    iam = boto.resource("iam")
-
     """
     A User wraps around service credentials, e.g. AWS account ids and secret keys
     """
@@ -450,7 +454,7 @@ class User(Saveable):
         except KeyError:
             raise Exception("No credentials found, have you called `load_credentials`?")
 
-        return User.iam.User(user_name)
+        return resource("iam").User(user_name)
 
 
 class Session(Saveable):
@@ -523,14 +527,12 @@ class PermissionedResource:
 
     """
 
-    iam = boto.resource("iam")
-
     def __init__(self, training_instance):
         self.training_instance = training_instance
         self._permission_resource()
 
     def _permission_resource(self):
-        policy = PermissionedResource.iam.create_policy(**self._policy_parameters())
+        policy = resource("iam").create_policy(**self._policy_parameters())
         iam_user = self.training_instance.user.iam_user
         iam_user.attach_policy(PolicyArn=policy.arn)
 
@@ -592,8 +594,6 @@ class Orchestrator:
     built around one TrainingInstance.
     """
 
-    iam = boto.resource("iam")
-
     def __init__(self, *, training_instance):
         self.training_instance = training_instance
         if not self._is_registered_training_instance():
@@ -607,7 +607,7 @@ class Orchestrator:
         """
 
         new_user = User()
-        aws_user = Orchestrator.iam.create_user(UserName=new_user.uuid)
+        aws_user = resource("iam").create_user(UserName=new_user.uuid)
         access_key_pair = aws_user.create_access_key_pair()
 
         new_user.credentials = {
@@ -4,8 +4,8 @@ import os
 import sys
 from pathlib import Path
 import zipfile
-import boto3 as boto
 from botocore.exceptions import ClientError
+from dalmatian.clients import resource, s3_transfer_config
 
 DEFAULT_INSTANCE_NAME = "amazing-artichoke"
 DEFAULT_BUCKET = "dalmatian"
@@ -34,12 +34,14 @@ def log(msg):
 # build_dir.mkdir(parents=True, exist_ok=True)
 
 # Check that the package exists, download it if necessary
-s3 = boto.resource("s3")
+s3 = resource("s3")
 package = Path(PACKAGE_LOCAL_LOCATION)
 if not package.is_file():
     try:
         print(PACKAGE_LOCAL_LOCATION)
-        s3.Object(DEFAULT_BUCKET, PACKAGE_KEY).download_file(PACKAGE_LOCAL_LOCATION)
+        s3.Object(DEFAULT_BUCKET, PACKAGE_KEY).download_file(
+            PACKAGE_LOCAL_LOCATION, Config=s3_transfer_config()
+        )
     except ClientError as e:
         if "Not Found" in repr(e):
             log(
@@ -91,8 +91,8 @@ def main(_):
                 "Train Accuracy:",
                 sess.run(accuracy, feed_dict={x: batch_xs, y_: batch_ys}),
             )
+            # Saves the variables along with the stored params
             dalm.store_params({'epoch': epoch})
-            dalm.checkpoint()
             checkpoint.save(sess)
 
     # Test trained model
@@ -100,6 +100,7 @@ def main(_):
         "Final Accuracy:",
         sess.run(accuracy, feed_dict={x: mnist.test.images, y_: mnist.test.labels}),
     )
+    checkpoint.close()
 
 
 if __name__ == "__main__":